@@ -0,0 +1,205 @@
+import argparse
+import itertools
+import json
+import numpy as np
+import os
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import platform
+from PIL import Image
+import pygame as pg
+import sys
+import tempfile
+import time
+
+from common import *
+from puzzle import Puzzle
+from tiled import TiledImage, open_image
+
+
+IMAGE_SIZES = [(1000, 750), (2000, 1500), (4000, 3000)]
+PIECE_COUNTS = [(10, 8), (30, 20), (60, 40)]
+ZOOMS = [0.05, 0.1, 0.25, 0.5, 1, 2]
+VIEWPORTS = [(800, 600), (1500, 1000), (2560, 1440)]
+
+
+def make_image(size, cache_dir):
+    # gradients under noise, so tiles compress and resample like a photo rather than a flat fill
+    w, h = size
+    xx, yy = np.meshgrid(np.linspace(0, 255, w), np.linspace(0, 255, h))
+    noise = np.random.randint(0, 64, (h, w))
+    pixels = np.dstack((xx, yy, 255 - (xx + yy) / 2)) * 0.75 + noise[..., None]
+    path = os.path.join(cache_dir, f"bench_{w}x{h}.png")
+    Image.fromarray(pixels.astype(np.uint8)).save(path)
+    return open_image(path, cache_dir)
+
+
+def time_runs(fn, repeat, setup=None, teardown=None):
+    samples = []
+    for _ in range(repeat):
+        arg = setup() if setup != None else None
+        start = time.perf_counter()
+        fn(arg)
+        samples.append(time.perf_counter() - start)
+        if teardown != None:
+            teardown(arg)
+    return samples
+
+
+def viewport(puzzle, zoom, view):
+    # the board region a window of this size shows at this zoom, centered like the space key does
+    vw, vh = view
+    ss_w, ss_h = min(max(1, vw / zoom), puzzle.w), min(max(1, vh / zoom), puzzle.h)
+    return int((puzzle.w - ss_w) / 2), int((puzzle.h - ss_h) / 2), int(ss_w), int(ss_h)
+
+
+def cold_copy(puzzle):
+    # a plain copy still shares the resized masks and the image's decoded tiles
+    other = puzzle.copy()
+    other.masks = {}
+    other.img = TiledImage(puzzle.img.path, puzzle.img.max_bytes)
+    return other
+
+
+def solve(puzzle, fraction=1):
+    # drop pieces near their solved spots, in random order, as a player would
+    n = len(puzzle.pieces)
+    for i in np.random.permutation(n)[:int(n * fraction)].tolist():
+        p = puzzle.pieces[i]
+        jx, jy = np.random.uniform(-0.4, 0.4, 2) * puzzle.connect_tol
+        puzzle.place_piece(p, puzzle.origin_x + p.col * puzzle.piece_w + jx,
+                              puzzle.origin_y + p.row * puzzle.piece_h + jy)
+        puzzle.connection_check(p)
+    assert fraction < 1 or puzzle.complete()
+
+
+def assemble(puzzle):
+    # join every piece into one group, off to the side of the board so nothing locks
+    solve_x = puzzle.origin_x + puzzle.img_w * 1.1
+    for p in puzzle.pieces:
+        puzzle.place_piece(p, solve_x + p.col * puzzle.piece_w, puzzle.origin_y + p.row * puzzle.piece_h)
+    for p in puzzle.pieces:
+        puzzle.connection_check(p)
+    assert puzzle.complete() and not puzzle.locked.any()
+
+
+def bench_build(images, repeat):
+    for size, img in images.items():
+        for width, height in PIECE_COUNTS:
+            samples = time_runs(lambda _: Puzzle(img, width, height), repeat)
+            yield 'build', {'image': size, 'pieces': (width, height)}, samples
+
+
+def bench_render(images, repeat):
+    img = images[IMAGE_SIZES[len(IMAGE_SIZES) // 2]]
+    width, height = PIECE_COUNTS[len(PIECE_COUNTS) // 2]
+    # mid-game, so the centered view shows both the assembled and the loose pieces
+    puzzle = Puzzle(img, width, height)
+    solve(puzzle, 0.5)
+    for zoom in ZOOMS:
+        for view in VIEWPORTS:
+            region = viewport(puzzle, zoom, view)
+            params = {'image': img.size, 'pieces': (width, height), 'zoom': zoom, 'viewport': view}
+            # nothing cut, resized or decoded yet, like the first frame after loading
+            cold = time_runs(lambda p: p.subsurface(*region, zoom), repeat,
+                             lambda: cold_copy(puzzle), lambda p: p.img.close())
+            yield 'render_cold', params, cold
+            puzzle.subsurface(*region, zoom)
+            warm = time_runs(lambda _: puzzle.subsurface(*region, zoom), repeat * 10)
+            yield 'render_warm', params, warm
+
+
+def bench_groups(images, repeat):
+    img = images[IMAGE_SIZES[0]]
+    for width, height in PIECE_COUNTS:
+        puzzle = Puzzle(img, width, height)
+        assemble(puzzle)
+        params = {'pieces': (width, height), 'group': width * height}
+        p = puzzle.pieces[len(puzzle.pieces) // 2]
+        x, y = p.disp_x + puzzle.piece_w / 2, p.disp_y + puzzle.piece_h / 2
+        yield 'click_check', params, time_runs(lambda _: puzzle.click_check(x, y), repeat * 10)
+        step = itertools.cycle(((1, 1), (-1, -1)))
+        yield 'move_piece', params, time_runs(lambda _: puzzle.move_piece(p, *next(step)), repeat * 10)
+
+
+def bench_solve(images, repeat):
+    img = images[IMAGE_SIZES[0]]
+    for width, height in PIECE_COUNTS:
+        puzzle = Puzzle(img, width, height)
+        samples = time_runs(solve, repeat, puzzle.copy)
+        yield 'solve', {'pieces': (width, height)}, samples
+
+
+BENCHES = {
+    'build': bench_build,
+    'render': bench_render,
+    'groups': bench_groups,
+    'solve': bench_solve,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""
+Benchmark puzzle building, rendering and snapping without a window.
+Run from the directory holding the piece masks. Timings are in seconds.
+
+    Run everything and save the results:
+
+        python3 bench.py -o bench.json
+
+    Quickly check rendering only:
+
+        python3 bench.py render -r 1""")
+
+    parser.add_argument('benches', help=f"Benchmarks to run (default: all of {', '.join(BENCHES)})",
+                        nargs='*', metavar='BENCH', default=list(BENCHES))
+    parser.add_argument('-r', '--repeat', help="Runs per measurement (default=5)",
+                        type=int, default=5)
+    parser.add_argument('-o', '--output', help="Write JSON results to a file instead of stdout",
+                        metavar='FILE', default=None)
+    parser.add_argument('--seed', help="Random seed, for comparable runs (default=0)",
+                        type=int, default=0)
+    args = parser.parse_args()
+
+    for name in args.benches:
+        if name not in BENCHES:
+            print(f"Error: Unknown benchmark '{name}'")
+            sys.exit(1)
+    if args.repeat < 1:
+        print("Error: Repeat count must be positive")
+        sys.exit(1)
+
+    np.random.seed(args.seed)
+    pg.init()
+    # surfaces convert to the display format, as they do in game
+    pg.display.set_mode((1, 1))
+
+    results = []
+    with tempfile.TemporaryDirectory() as cache_dir:
+        images = {size: make_image(size, cache_dir) for size in IMAGE_SIZES}
+        for name in args.benches:
+            for bench, params, samples in BENCHES[name](images, args.repeat):
+                results.append({'bench': bench, 'params': params, 'seconds': summarize(samples)})
+                print(f"{bench} {params}: {np.median(samples):.6f}s", file=sys.stderr)
+        for img in images.values():
+            img.close()
+
+    report = {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pygame': pg.version.ver,
+        'platform': platform.platform(),
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+    pg.quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,4 @@
-import pickle
+import numpy as np
 from PIL import Image
 import struct
 
@@ -6,10 +6,21 @@ import struct
 BG_COLOR = (44, 47, 51)
 WHITE = (255, 255, 255)
 BLACK = (0, 0, 0)
+GRAY = (114, 118, 125)
 
 REQ_LEN = len("a".encode())
 
+DEFAULT_ROOM = "default"
+
+ROOM_REQ = "r".encode()
+ROOM_FMT = ">I"
+ROOM_LEN = len(struct.pack(ROOM_FMT, 1))
+ROOM_RES_FMT = ">?"
+ROOM_RES_LEN = len(struct.pack(ROOM_RES_FMT, True))
+
 IMG_REQ = "g".encode()
+IMG_REQ_FMT = ">I"
+IMG_REQ_LEN = len(struct.pack(IMG_REQ_FMT, 1))
 IMG_FMT = ">III"
 IMG_RES_LEN = len(struct.pack(IMG_FMT, 1, 2, 3))
 
@@ -22,15 +33,50 @@ UPDATE_FMT = ">II"
 UPDATE_RES_LEN = len(struct.pack(UPDATE_FMT, 1, 2))
 
 MOVE_REQ = "m".encode()
-MOVE_FMT = ">IIII"
+MOVE_FMT = ">IIdd"
 MOVE_LEN = len(struct.pack(MOVE_FMT, 1, 2, 3, 4))
 
 IDX_REQ = "d".encode()
 IDX_FMT = ">I"
 IDX_LEN = len(struct.pack(IDX_FMT, 1))
 
-CURSOR_FMT = ">Iddiidd"
-CURSOR_LEN = len(struct.pack(CURSOR_FMT, 0, 1, 2, 3, 4, 5, 6))
+CURSOR_FMT = ">Iddiiddd"
+CURSOR_LEN = len(struct.pack(CURSOR_FMT, 0, 1, 2, 3, 4, 5, 6, 7))
+
+
+def summarize(samples):
+    # the spread of a set of timings, as reported by the benchmark and load tools
+    if len(samples) == 0:
+        return {'count': 0}
+    samples = np.asarray(samples, dtype=float)
+    p50, p90, p99 = np.percentile(samples, (50, 90, 99))
+    return {'count': len(samples), 'min': float(samples.min()), 'mean': float(samples.mean()),
+            'p50': float(p50), 'p90': float(p90), 'p99': float(p99), 'max': float(samples.max())}
+
+
+def pack_room_req(name):
+    name = name.encode()
+    return struct.pack(ROOM_FMT, len(name)) + name
+
+
+def unpack_room_len(msg):
+    return struct.unpack(ROOM_FMT, msg)
+
+
+def pack_room_res(found):
+    return struct.pack(ROOM_RES_FMT, found)
+
+
+def unpack_room_res(msg):
+    return struct.unpack(ROOM_RES_FMT, msg)
+
+
+def pack_img_req(max_dim):
+    return struct.pack(IMG_REQ_FMT, max_dim)
+
+
+def unpack_img_req(msg):
+    return struct.unpack(IMG_REQ_FMT, msg)
 
 
 def pack_img_res(img_size, w, h):
@@ -69,7 +115,7 @@ class Move():
     def __init__(self, piece=None):
         if piece != None:
             self.r, self.c = int(piece.row), int(piece.col)
-            self.x, self.y = int(piece.disp_x), int(piece.disp_y)
+            self.x, self.y = map(float, piece.puzzle.to_board(piece.disp_x, piece.disp_y))
 
 
     def __str__(self):
@@ -86,7 +132,7 @@ class Move():
 
 
 class Cursor():
-    def __init__(self, idx=0, x=0, y=0, pr=-1, pc=-1, px=0, py=0):
+    def __init__(self, idx=0, x=0, y=0, pr=-1, pc=-1, px=0, py=0, t=0):
         self.idx = idx
         self.x = x
         self.y = y
@@ -94,10 +140,11 @@ class Cursor():
         self.pc = pc
         self.px = px
         self.py = py
+        self.t = t
     
     def pack(self):
-        return struct.pack(CURSOR_FMT, self.idx, self.x, self.y, self.pr, self.pc, self.px, self.py)
+        return struct.pack(CURSOR_FMT, self.idx, self.x, self.y, self.pr, self.pc, self.px, self.py, self.t)
     
     def unpack(self, string):
-        self.idx, self.x, self.y, self.pr, self.pc, self.px, self.py = struct.unpack(CURSOR_FMT, string)
+        self.idx, self.x, self.y, self.pr, self.pc, self.px, self.py, self.t = struct.unpack(CURSOR_FMT, string)
         return self
\ No newline at end of file
@@ -3,20 +3,22 @@ from math import sqrt
 import multiprocessing as mp
 import os
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
-import platform
 import pygame as pg
 import socket
 import struct
 import subprocess
 import sys
+import threading
 import time
 import uuid
 
 from common import *
 from puzzle import Puzzle
+from server import serve_in_process
+from stats import FrameStats, NullStats
+from tiled import TILE_HEADER_LEN, TiledImage, fit_size, open_image
 
 
-server_process = None
 viewer_process = None
 
 
@@ -25,9 +27,45 @@ if __name__ == '__main__':
     cursors = manager.dict()
 
 
+class CursorTrack():
+    max_extrapolation = 1.5
+
+    def __init__(self, cursor):
+        self.prev = self.last = cursor
+        self.offset = time.time() - cursor.t
+
+
+    def add(self, cursor):
+        # the server repeats the latest sample until a newer one arrives
+        if cursor.t <= self.last.t:
+            return
+        self.offset = min(self.offset, time.time() - cursor.t)
+        self.prev, self.last = self.last, cursor
+
+
+    def sample(self, t):
+        a, b = self.prev, self.last
+        span = b.t - a.t
+        if span <= 0:
+            # a copy, as callers convert the sample in place
+            return Cursor(b.idx, b.x, b.y, b.pr, b.pc, b.px, b.py, b.t)
+
+        # render one sample interval behind the sender, mapped into its clock
+        f = (t - self.offset - span - a.t) / span
+        f = min(max(f, 0), self.max_extrapolation)
+        lerp = lambda u, v: u + (v - u) * f
+
+        cursor = Cursor(b.idx, lerp(a.x, b.x), lerp(a.y, b.y), b.pr, b.pc, b.px, b.py, b.t)
+        if b.pr != -1 and (a.pr, a.pc) == (b.pr, b.pc):
+            cursor.px, cursor.py = lerp(a.px, b.px), lerp(a.py, b.py)
+        return cursor
+
+
 class Moveplexer():
-    def __init__(self, sock, idx):
+    def __init__(self, sock, idx, update_rate=30):
         self.sock = sock
+        self.update_rate = update_rate
+        self.tracks = {}
         self.incoming_moves = mp.Queue()
         self.outgoing_moves = mp.Queue()
         self.cursor = mp.Queue(1)
@@ -47,36 +85,64 @@ class Moveplexer():
             return self.incoming_moves.get()
 
             
-    def get_cursors(self):
-        return cursors.values()
+    def get_cursors(self, puzzle):
+        # t == 0 is the server's placeholder for a client that hasn't sent a cursor yet
+        latest = {c.idx: c for c in cursors.values() if c.t != 0}
+        # samples of pieces that have since been let go of
+        released = []
+        for i in list(self.tracks.keys()):
+            if i not in latest:
+                released.append(self.tracks.pop(i).last)
+        for i, c in latest.items():
+            if i in self.tracks:
+                held = self.tracks[i].last
+                self.tracks[i].add(c)
+                if (held.pr, held.pc) != (self.tracks[i].last.pr, self.tracks[i].last.pc):
+                    released.append(held)
+            else:
+                self.tracks[i] = CursorTrack(c)
+        # held samples can carry a piece past where its move put it, so it's put back
+        for c in released:
+            if c.pr != -1 and c.pc != -1:
+                for p in puzzle.matrix[(c.pr, c.pc)].group:
+                    p.place()
+        t = time.time()
+        samples = [track.sample(t) for track in self.tracks.values()]
+        for c in samples:
+            c.x, c.y = puzzle.from_board(c.x, c.y)
+            c.px, c.py = puzzle.from_board(c.px, c.py)
+        return samples
 
         
-    def init_puzzle(self, puzzle):
-        self.sock.sendall(INIT_REQ)
-        move_count = unpack_init_res(self.sock.recv(INIT_RES_LEN))[0]
-        for _ in range(move_count):
-            move = Move().unpack(self.sock.recv(MOVE_LEN))
+    def init_puzzle(self, puzzle, moves=None):
+        if moves == None:
+            moves = recv_init(self.sock)
+        for move in moves:
             p = puzzle.matrix[(move.r, move.c)]
-            puzzle.place_piece(p, move.x, move.y)
+            puzzle.place_piece(p, *puzzle.from_board(move.x, move.y))
+        # rejoin pieces that were connected when the layout was snapshotted
+        for p in puzzle.pieces:
+            puzzle.single_connection_check(p)
 
                 
     def update(self, puzzle, holding, cursor_pos):
         move = self.get_move()
         while move != None:
             p = puzzle.matrix[(move.r, move.c)]
-            puzzle.place_piece(p, move.x, move.y)
+            puzzle.place_piece(p, *puzzle.from_board(move.x, move.y))
             puzzle.connection_check(p)
             if holding in p.group: holding = None
             move = self.get_move()
 
         with self.cursor_lock:
             cursor = Cursor().unpack(self.cursor.get())
-            cursor.x, cursor.y = cursor_pos
+            cursor.x, cursor.y = puzzle.to_board(*cursor_pos)
+            cursor.t = time.time()
             if holding == None:
                 cursor.pr, cursor.pc = -1, -1
             else:
                 cursor.pr, cursor.pc = holding.row, holding.col
-                cursor.px, cursor.py = holding.disp_x, holding.disp_y
+                cursor.px, cursor.py = puzzle.to_board(holding.disp_x, holding.disp_y)
             self.cursor.put(cursor.pack())
             
         return holding
@@ -88,7 +154,7 @@ class Moveplexer():
         
     def run(self, sock, cursors):
         update_time = time.time()
-        update_interval = 1 / 30
+        update_interval = 1 / self.update_rate
         try:
             while True:
                 while not self.outgoing_moves.empty():
@@ -124,13 +190,78 @@ class Moveplexer():
         self.proc.terminate()
 
         
-def open_image_viewer(img):
+def recv_init(sock):
+    sock.sendall(INIT_REQ)
+    move_count = unpack_init_res(sock.recv(INIT_RES_LEN, socket.MSG_WAITALL))[0]
+    return [Move().unpack(sock.recv(MOVE_LEN, socket.MSG_WAITALL)) for _ in range(move_count)]
+
+
+class Loader(threading.Thread):
+    # Fetches the layout, then streams the image to disk, so the puzzle
+    # can be built and played while the rest of the image arrives.
+
+    def __init__(self, sock, max_dim):
+        super().__init__(daemon=True)
+        self.sock = sock
+        self.max_dim = max_dim
+        try:
+            os.mkdir("image_cache")
+        except FileExistsError:
+            pass
+        self.path = "image_cache/" + str(uuid.uuid4()) + ".tiles"
+        self.moves = None
+        self.width = self.height = None
+        self.received, self.total = 0, 0
+        self.error = None
+        self.header_ready = threading.Event()
+        self.done = threading.Event()
+
+
+    def run(self):
+        try:
+            self.moves = recv_init(self.sock)
+            self.sock.sendall(IMG_REQ)
+            self.sock.sendall(pack_img_req(self.max_dim))
+            self.total, self.width, self.height = unpack_img_res(self.sock.recv(IMG_RES_LEN, socket.MSG_WAITALL))
+            with open(self.path, 'wb') as f:
+                while self.received < self.total:
+                    chunk = self.sock.recv(min(self.total - self.received, 2**16))
+                    if not chunk:
+                        raise ConnectionError("Server closed the connection during download")
+                    f.write(chunk)
+                    f.flush()
+                    self.received += len(chunk)
+                    if self.received >= TILE_HEADER_LEN:
+                        self.header_ready.set()
+        except (OSError, struct.error) as exc:
+            self.error = exc
+        finally:
+            self.header_ready.set()
+            self.done.set()
+
+
+def draw_progress(screen, font, text, fraction):
+    sw, sh = screen.get_size()
+    bar_w, bar_h = sw // 3, 12
+    x, y = (sw - bar_w) // 2, sh // 2
+    screen.fill(BG_COLOR)
+    label = font.render(text, True, WHITE)
+    screen.blit(label, ((sw - label.get_width()) // 2, y - label.get_height() - bar_h))
+    pg.draw.rect(screen, GRAY, (x, y, bar_w, bar_h))
+    pg.draw.rect(screen, WHITE, (x, y, int(bar_w * fraction), bar_h))
+    pg.display.flip()
+
+
+def open_image_viewer(path, max_dim=4096):
     try:
         os.mkdir("image_cache")
     except FileExistsError:
         pass
     filename = "image_cache/" + str(uuid.uuid4()) + ".png"
-    img.save(filename)
+    # a separate handle, as this runs alongside the game cutting pieces from the image
+    img = TiledImage(path)
+    preview = img.resize(fit_size(img.size, max_dim))
+    preview.crop((0, 0) + preview.size).save(filename)
     image_viewer = {'linux': 'xdg-open', 'win32': 'start', 'darwin': 'open'}[sys.platform]
     shell = sys.platform == 'win32'
     with open(os.devnull, 'wb') as shutup:
@@ -169,20 +300,36 @@ The port (default=7777) must be forwarded to host an online game.
                         metavar='IMAGE', default=False)
     parser.add_argument('-p', '--port', help="Port to connect to or host from",
                         default="7777")
+    parser.add_argument('-r', '--room', help=f"Room to join on a multi-room server (default={DEFAULT_ROOM})",
+                        default=DEFAULT_ROOM)
     parser.add_argument('-d', '--dimensions', help="Specify puzzle dimensions (pieces)",
                         nargs=2, metavar=('WIDTH', 'HEIGHT'), type=int, default=False)
+    parser.add_argument('-u', '--update-rate', help="Network update rate in Hz (remote cursors are interpolated between updates)",
+                        metavar='HZ', type=float, default=30)
+    parser.add_argument('-m', '--max-resolution', help="Limit the puzzle's largest dimension (pixels). Online, only a matching resolution is downloaded",
+                        metavar='RESOLUTION', type=int, default=-1)
     parser.add_argument('-n', '--no-viewer', help="Don't open an accompanying image viewer",
                         action='store_true', default=False)
     parser.add_argument('-e', '--escape-exit', help="Let the escape key exit the program",
                         action='store_true', default=False)
+    parser.add_argument('--stats', help="Time each frame's phases and overlay the percentiles (F3 toggles the overlay)",
+                        action='store_true', default=False)
+    parser.add_argument('--stats-log', help="Time each frame's phases and append a JSON summary to a file periodically",
+                        metavar='FILE', default=None)
+    parser.add_argument('--stats-interval', help="Seconds between summaries in the stats log (default=5)",
+                        metavar='SECONDS', type=float, default=5)
     args = parser.parse_args()
 
+    if args.update_rate <= 0:
+        print("Error: Update rate must be positive")
+        sys.exit()
+
     if args.offline or args.server:
         if args.offline:
             img_path = args.offline
         else:
             img_path = args.server
-        img = Image.open(img_path)
+        img = open_image(img_path)
         
         if args.dimensions:
             width, height = args.dimensions
@@ -207,45 +354,51 @@ The port (default=7777) must be forwarded to host an online game.
                 width = max(2, width)
                 height = max(2, height)
 
+    puzzle = None
+    loader = None
+    if args.offline or args.server:
+        print("Building puzzle...")
+        puzzle = Puzzle(img, int(width), int(height), downscale=args.max_resolution)
+        print("Done.")
+
     if args.server or args.connect:
         if args.server:
             print("Starting server...")
-            global server_process
-
-            if platform.system() == 'Linux':
-                py_cmd = "python3"
-            else:
-                py_cmd = "python"
-            server_process = subprocess.Popen([py_cmd, "server.py", args.port, img_path, str(width), str(height)])
-            args.connect = socket.gethostname()
+            try:
+                # the server is listening with the room ready once this returns
+                serve_in_process(int(args.port), img, puzzle, args.room)
+                sock = socket.create_connection(("localhost", int(args.port)))
+            except OSError as exc:
+                print("Error: Could not start server: " + str(exc))
+                sys.exit(1)
         else:
             print("Connecting to server...")
-
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        start_time = time.time()
-        while True:
-            if time.time() - start_time > 60:
-                print("Error: Could not connect to server")
-                sys.exit(1)
-                # start_time = time.time()
-            try:
-                sock.connect((args.connect, int(args.port)))
-                break
-            except:
-                pass
+            start_time = time.time()
+            while True:
+                if time.time() - start_time > 60:
+                    print("Error: Could not connect to server")
+                    sys.exit(1)
+                try:
+                    sock = socket.create_connection((args.connect, int(args.port)))
+                    break
+                except OSError:
+                    time.sleep(0.5)
         print("Done.")
 
+        sock.sendall(ROOM_REQ)
+        sock.sendall(pack_room_req(args.room))
+        if not unpack_room_res(sock.recv(ROOM_RES_LEN))[0]:
+            print(f"Error: The server has no room named '{args.room}'")
+            sys.exit(1)
+
         sock.sendall(IDX_REQ)
         idx = unpack_idx(sock.recv(IDX_LEN))[0]
 
         if not args.server:
-            print("Downloading image...")
-            sock.sendall(IMG_REQ)
-            img_size, width, height = unpack_img_res(sock.recv(IMG_RES_LEN))
-            img = pickle.loads(sock.recv(img_size, socket.MSG_WAITALL))
-            print("Done.")
+            loader = Loader(sock, max(0, args.max_resolution))
+            loader.start()
 
-        moveplexer = Moveplexer(sock, idx)
+        moveplexer = Moveplexer(sock, idx, args.update_rate)
     elif not args.offline:
         print("Error: A game mode argume is required [-o | -c | -s]")
         sys.exit()
@@ -257,17 +410,39 @@ The port (default=7777) must be forwarded to host an online game.
         pass
 
     display_flags = pg.RESIZABLE
-    print("Building puzzle...")
-    puzzle = Puzzle(img, int(width), int(height))
-    if not args.offline: moveplexer.init_puzzle(puzzle)
-    print("Done.")
-
-    if not args.no_viewer:
-        open_image_viewer(puzzle.img)
-
     sw, sh = 1500, 1000
     screen = pg.display.set_mode([sw, sh], flags=display_flags)
 
+    if puzzle == None:
+        # play can start as soon as the image's size is known, unless it has to be
+        # downscaled, which needs all of it
+        font = pg.font.Font(None, 32)
+        waiting = loader.header_ready
+        while True:
+            if waiting.wait(1 / 30):
+                if loader.error != None:
+                    print("Error: Could not download image: " + str(loader.error))
+                    sys.exit(1)
+                img = TiledImage(loader.path)
+                if waiting is loader.done or args.max_resolution <= 0 or max(img.size) <= args.max_resolution:
+                    break
+                img.close()
+                waiting = loader.done
+            for event in pg.event.get():
+                if event.type == pg.QUIT:
+                    sys.exit()
+                elif event.type == pg.VIDEORESIZE:
+                    sw, sh = event.w, event.h
+                    screen = pg.display.set_mode([sw, sh], flags=display_flags)
+            fraction = loader.received / loader.total if loader.total else 0
+            draw_progress(screen, font, "Downloading image...", fraction)
+        puzzle = Puzzle(img, int(loader.width), int(loader.height), downscale=args.max_resolution)
+        moveplexer.init_puzzle(puzzle, loader.moves)
+    elif not args.offline:
+        moveplexer.init_puzzle(puzzle)
+
+    viewer_path = None if args.no_viewer else puzzle.img.path
+
     pw, ph = puzzle.w, puzzle.h
     scale = min(sw / pw, sh / ph)
     scale_factor = 10 / 9
@@ -283,11 +458,29 @@ The port (default=7777) must be forwarded to host an online game.
     cursor_img = pg.image.load('cursor.png')
     cursor_img = pg.transform.scale(cursor_img, (int(cursor_img.get_width() / 2), int(cursor_img.get_height() / 2)))
 
-    if not args.offline: moveplexer.start_process()
+    if args.stats or args.stats_log:
+        stats = FrameStats(overlay=args.stats, log_path=args.stats_log, log_interval=args.stats_interval)
+    else:
+        stats = NullStats()
+
+    # the moveplexer shares the socket, so it waits for any download to finish
+    syncing = not args.offline
     running = True
     while running:
+        if viewer_path != None and (loader == None or loader.done.is_set()):
+            threading.Thread(target=open_image_viewer, args=(viewer_path,), daemon=True).start()
+            viewer_path = None
+        if syncing and (loader == None or loader.done.is_set()):
+            if loader != None and loader.error != None:
+                print("Error: Could not download image: " + str(loader.error))
+                break
+            moveplexer.start_process()
+            syncing = False
         if not args.offline:
             holding = moveplexer.update(puzzle, holding, cursor_pos)
+        stats.mark('update')
+        puzzle.poll_source(0.005)
+        stats.mark('load')
 
         for event in pg.event.get():
             if event.type == pg.QUIT:
@@ -298,6 +491,8 @@ The port (default=7777) must be forwarded to host an online game.
                 if event.key == pg.K_SPACE:
                     pan_x = pw / 2 - sw / scale / 2
                     pan_y = ph / 2 - sh / scale / 2
+                if event.key == pg.K_F3:
+                    stats.overlay = not stats.overlay
             elif event.type == pg.VIDEORESIZE:
                 sw, sh = event.w, event.h
                 screen = pg.display.set_mode([sw, sh], flags=display_flags)
@@ -336,6 +531,7 @@ The port (default=7777) must be forwarded to host an online game.
                     pan_y -= my
                 elif holding != None:
                     puzzle.move_piece(holding, mx, my)
+        stats.mark('events')
 
         ss_width = min(max(1, sw / scale), pw)
         ss_height = min(max(1, sh / scale), ph)
@@ -362,9 +558,10 @@ The port (default=7777) must be forwarded to host an online game.
 
         screen.fill(BG_COLOR)
         screen.blit(puzzle.subsurface(int(ss_x), int(ss_y), int(ss_width), int(ss_height), scale), (blit_x, blit_y))
+        stats.mark('render')
 
         if not args.offline:
-            for cursor in moveplexer.get_cursors():
+            for cursor in moveplexer.get_cursors(puzzle):
                 if (pan_x < cursor.x < pan_x + sw / scale and
                     pan_y < cursor.y < pan_y + sh / scale):
                     screen.blit(cursor_img, (int((cursor.x - pan_x) * scale), int((cursor.y - pan_y) * scale)))
@@ -373,8 +570,11 @@ The port (default=7777) must be forwarded to host an online game.
                     if holding == p: holding = None
                     dx, dy = cursor.px - p.disp_x, cursor.py - p.disp_y
                     puzzle.move_piece(p, dx, dy)
+        stats.mark('cursors')
 
+        stats.draw(screen)
         pg.display.flip()
+        stats.mark('flip')
 
         cursor_pos = (mouse_pos[0] / scale + pan_x, mouse_pos[1] / scale + pan_y)
         
@@ -382,8 +582,10 @@ The port (default=7777) must be forwarded to host an online game.
             pg.mixer.music.load('congrats.wav')
             pg.mixer.music.set_volume(1)
             pg.mixer.music.play(-1)
+        stats.end_frame(puzzle.counters)
 
-    if not args.offline: moveplexer.shutdown()
+    stats.close()
+    if not args.offline and not syncing: moveplexer.shutdown()
     pg.quit()
 
 
@@ -391,7 +593,5 @@ if __name__ == "__main__":
     try:
         main()
     finally:
-        if server_process != None:
-            server_process.kill()
         if viewer_process != None:
             viewer_process.kill()
\ No newline at end of file
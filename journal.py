@@ -0,0 +1,109 @@
+import numpy as np
+import os
+import struct
+
+from common import *
+
+
+JOURNAL_MAGIC = "JUFJ".encode()
+SNAPSHOT_MAGIC = "JUFS".encode()
+HEADER_FMT = ">4sIIQ"
+HEADER_LEN = len(struct.pack(HEADER_FMT, JOURNAL_MAGIC, 1, 2, 3))
+
+# a packed Move, as a record
+MOVE_DTYPE = np.dtype([('r', '>u4'), ('c', '>u4'), ('x', '>f8'), ('y', '>f8')])
+assert MOVE_DTYPE.itemsize == MOVE_LEN
+
+
+def read_header(f, magic):
+    header = f.read(HEADER_LEN)
+    if len(header) < HEADER_LEN:
+        return None
+    file_magic, width, height, gen = struct.unpack(HEADER_FMT, header)
+    if file_magic != magic:
+        return None
+    return width, height, gen
+
+
+class Journal():
+    # The journal holds every move since the snapshot of the same generation.
+    # A snapshot is written before its journal is truncated, so a journal
+    # from an older generation than the snapshot is already covered by it.
+
+    def __init__(self, path, width, height):
+        self.journal_path = path + ".journal"
+        self.snapshot_path = path + ".snapshot"
+        self.width, self.height = width, height
+        self.gen = 0
+        self.file = None
+
+
+    def load(self):
+        # returns (records, gid, locked, tail moves), or None if there's nothing to resume
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                header = read_header(f, SNAPSHOT_MAGIC)
+                if header == None or header[:2] != (self.width, self.height):
+                    return None
+                n = self.width * self.height
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        if len(data) != n * (MOVE_LEN + 4 + 1):
+            return None
+        self.gen = header[2]
+        records = np.frombuffer(data, MOVE_DTYPE, n)
+        gid = np.frombuffer(data, '>u4', n, n * MOVE_LEN).astype(int)
+        locked = np.frombuffer(data, bool, n, n * (MOVE_LEN + 4))
+
+        tail = []
+        try:
+            with open(self.journal_path, 'rb') as f:
+                header = read_header(f, JOURNAL_MAGIC)
+                if header != None and header[2] == self.gen:
+                    data = f.read()
+                    # a partly written record at the end is dropped
+                    tail = [data[i:i + MOVE_LEN] for i in range(0, len(data) - MOVE_LEN + 1, MOVE_LEN)]
+        except FileNotFoundError:
+            pass
+        self.open(len(tail))
+        return records, gid, locked, tail
+
+
+    def open(self, keep=0):
+        # continue the current journal after its first `keep` moves, or start a new one
+        if self.file != None:
+            self.file.close()
+        if keep:
+            self.file = open(self.journal_path, 'r+b', buffering=2**16)
+            self.file.truncate(HEADER_LEN + keep * MOVE_LEN)
+            self.file.seek(0, os.SEEK_END)
+        else:
+            self.file = open(self.journal_path, 'wb', buffering=2**16)
+            self.file.write(struct.pack(HEADER_FMT, JOURNAL_MAGIC, self.width, self.height, self.gen))
+            self.file.flush()
+
+
+    def append(self, move):
+        self.file.write(move)
+
+
+    def flush(self):
+        self.file.flush()
+
+
+    def snapshot(self, records, gid, locked):
+        tmp = self.snapshot_path + ".tmp"
+        with open(tmp, 'wb') as f:
+            f.write(struct.pack(HEADER_FMT, SNAPSHOT_MAGIC, self.width, self.height, self.gen + 1))
+            f.write(records.astype(MOVE_DTYPE).tobytes())
+            f.write(gid.astype('>u4').tobytes())
+            f.write(locked.astype(bool).tobytes())
+        os.replace(tmp, self.snapshot_path)
+        self.gen += 1
+        self.open()
+
+
+    def close(self):
+        if self.file != None:
+            self.file.close()
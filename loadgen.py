@@ -0,0 +1,430 @@
+import argparse
+from collections import OrderedDict, deque
+import heapq
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import sys
+import time
+
+from common import *
+
+
+# how long a sent move is remembered for matching against other bots' updates
+FANOUT_WINDOW = 30
+
+# the part of the board, in image widths and heights, that bots move pieces and cursors over
+BOARD_EXTENT = 4.8
+
+# seconds a replay runs past its last event, so the replies to it are counted
+REPLAY_TAIL = 1
+
+
+def cpu_seconds(pid):
+    # user + system time of a process and all of its descendants, from /proc (Linux only)
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        total = (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+        for task in os.listdir(f"/proc/{pid}/task"):
+            with open(f"/proc/{pid}/task/{task}/children") as f:
+                total += sum(cpu_seconds(int(child)) for child in f.read().split())
+        return total
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def read_trace(path):
+    # returns a recorded session's events, its length and the most bots it had connected at once
+    with open(path) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    bots, peak = 0, 0
+    for event in sorted(events, key=lambda event: event['t']):
+        if event['op'] == 'join':
+            bots += 1
+            peak = max(peak, bots)
+        elif event['op'] == 'leave':
+            bots -= 1
+    duration = max(event['t'] for event in events) + REPLAY_TAIL if events else 0
+    return events, duration, peak
+
+
+class Bot():
+    def __init__(self, slot, sock, now):
+        self.slot = slot
+        self.sock = sock
+        self.joined = now
+        self.ready = False
+        self.dims = None
+        self.out = bytearray()
+        self.buf = bytearray()
+        # responses still to come, in request order
+        self.expect = deque()
+        self.header = None
+        self.body = 0
+        self.update_sent = None
+
+
+    def send(self, *msgs):
+        for msg in msgs:
+            self.out += msg
+
+
+class Load():
+    def __init__(self, args, events=None):
+        self.args = args
+        self.events = events
+        self.selector = selectors.DefaultSelector()
+        self.bots = {}
+        self.timers = []
+        self.seq = 0
+        self.next_slot = args.bots
+        self.start = time.time()
+        self.trace = None
+        self.sent_moves = OrderedDict()
+        self.counts = dict.fromkeys(('joins', 'failed_joins', 'leaves', 'disconnects', 'moves_sent',
+                                     'updates', 'skipped', 'moves_received', 'fanout',
+                                     'bytes_sent', 'bytes_received'), 0)
+        self.latency = {'fanout': [], 'update': [], 'join': []}
+
+
+    def schedule(self, t, slot, op, data=None):
+        heapq.heappush(self.timers, (t, self.seq, slot, op, data))
+        self.seq += 1
+
+
+    def record(self, now, slot, op, data):
+        if self.trace != None:
+            event = {'t': round(now - self.start, 6), 'bot': slot, 'op': op}
+            if data != None:
+                event['data'] = data
+            self.trace.write(json.dumps(event) + "\n")
+
+
+    def run_op(self, now, slot, op, data):
+        bot = self.bots.get(slot)
+        if op == 'join':
+            if bot == None:
+                self.join(now, slot)
+                self.record(now, slot, op, data)
+            return
+        if bot == None or not bot.ready:
+            # a generated timer can outlive its bot, which is expected rather than skipped
+            if bot != None or self.args.replay:
+                self.counts['skipped'] += 1
+            return
+
+        self.record(now, slot, op, data)
+        if op == 'leave':
+            self.drop(bot)
+            self.counts['leaves'] += 1
+            if not self.args.replay:
+                # keep the population steady, so churn doesn't thin out the load
+                self.schedule(now, self.next_slot, 'join')
+                self.next_slot += 1
+            return
+        elif op == 'move':
+            r, c, x, y = data
+            move = struct.pack(MOVE_FMT, r, c, x, y)
+            bot.send(MOVE_REQ, move)
+            self.sent_moves[move] = (slot, now)
+            self.counts['moves_sent'] += 1
+            if not self.args.replay:
+                self.schedule(now + random.expovariate(self.args.move_rate), slot, 'move', self.random_move(bot))
+        elif op == 'update':
+            if bot.update_sent != None:
+                # a real client waits on its last update before sending another
+                self.counts['skipped'] += 1
+            else:
+                x, y = data
+                bot.send(UPDATE_REQ, Cursor(bot.idx, x, y, t=now).pack())
+                bot.expect.append('update')
+                bot.update_sent = now
+            if not self.args.replay:
+                self.schedule(now + 1 / self.args.cursor_rate, slot, 'update', self.random_cursor())
+        self.flush(bot)
+
+
+    def random_move(self, bot):
+        w, h = bot.dims
+        return (random.randrange(h), random.randrange(w),
+                random.uniform(0, BOARD_EXTENT), random.uniform(0, BOARD_EXTENT))
+
+
+    def random_cursor(self):
+        return random.uniform(0, BOARD_EXTENT), random.uniform(0, BOARD_EXTENT)
+
+
+    def join(self, now, slot):
+        try:
+            sock = socket.create_connection((self.args.host, self.args.port))
+        except OSError:
+            self.counts['failed_joins'] += 1
+            return
+        sock.setblocking(False)
+        bot = Bot(slot, sock, now)
+        self.bots[slot] = bot
+        self.selector.register(sock, selectors.EVENT_READ, bot)
+        bot.send(ROOM_REQ, pack_room_req(self.args.room))
+        bot.expect.append('room')
+        self.flush(bot)
+
+
+    def drop(self, bot):
+        self.selector.unregister(bot.sock)
+        bot.sock.close()
+        self.bots.pop(bot.slot, None)
+
+
+    def flush(self, bot):
+        try:
+            if bot.out:
+                sent = bot.sock.send(bot.out)
+                del bot.out[:sent]
+                self.counts['bytes_sent'] += sent
+        except BlockingIOError:
+            pass
+        except OSError:
+            self.drop(bot)
+            self.counts['disconnects'] += 1
+            return
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if bot.out else 0)
+        self.selector.modify(bot.sock, events, bot)
+
+
+    def receive(self, bot, now):
+        try:
+            data = bot.sock.recv(2**16)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b""
+        if not data:
+            self.drop(bot)
+            self.counts['disconnects'] += 1
+            return
+        self.counts['bytes_received'] += len(data)
+        bot.buf += data
+
+        while bot.expect and bot.slot in self.bots:
+            kind = bot.expect[0]
+            if bot.header == None:
+                header_len = {'room': ROOM_RES_LEN, 'idx': IDX_LEN, 'img': IMG_RES_LEN,
+                              'init': INIT_RES_LEN, 'update': UPDATE_RES_LEN}[kind]
+                if len(bot.buf) < header_len:
+                    return
+                bot.header = bytes(bot.buf[:header_len])
+                del bot.buf[:header_len]
+                bot.body = self.body_len(kind, bot.header)
+            if kind == 'img':
+                # the image itself is only counted, never kept
+                n = min(bot.body, len(bot.buf))
+                del bot.buf[:n]
+                bot.body -= n
+                if bot.body:
+                    return
+                body = b""
+            else:
+                if len(bot.buf) < bot.body:
+                    return
+                body = bytes(bot.buf[:bot.body])
+                del bot.buf[:bot.body]
+            header = bot.header
+            bot.header = None
+            bot.expect.popleft()
+            self.respond(bot, kind, header, body, now)
+
+
+    def body_len(self, kind, header):
+        if kind == 'img':
+            return unpack_img_res(header)[0]
+        elif kind == 'init':
+            return unpack_init_res(header)[0] * MOVE_LEN
+        elif kind == 'update':
+            move_count, cursor_count = unpack_update_res(header)
+            return move_count * MOVE_LEN + cursor_count * CURSOR_LEN
+        return 0
+
+
+    def respond(self, bot, kind, header, body, now):
+        if kind == 'room':
+            if not unpack_room_res(header)[0]:
+                print(f"Error: The server has no room named '{self.args.room}'", file=sys.stderr)
+                self.drop(bot)
+                self.counts['failed_joins'] += 1
+                return
+            # pipelined the way a joining client asks for them
+            bot.send(IDX_REQ, INIT_REQ, IMG_REQ, pack_img_req(self.args.image_resolution))
+            bot.expect.extend(('idx', 'init', 'img'))
+            self.flush(bot)
+        elif kind == 'idx':
+            bot.idx = unpack_idx(header)[0]
+        elif kind == 'img':
+            bot.dims = unpack_img_res(header)[1:]
+            bot.ready = True
+            self.counts['joins'] += 1
+            self.latency['join'].append(now - bot.joined)
+            if not self.args.replay:
+                slot = bot.slot
+                self.schedule(now + random.uniform(0, 1 / self.args.cursor_rate), slot, 'update', self.random_cursor())
+                if self.args.move_rate > 0:
+                    self.schedule(now + random.expovariate(self.args.move_rate), slot, 'move', self.random_move(bot))
+                if self.args.churn > 0:
+                    self.schedule(now + random.expovariate(self.args.churn / self.args.bots), slot, 'leave')
+        elif kind == 'update':
+            self.counts['updates'] += 1
+            self.latency['update'].append(now - bot.update_sent)
+            bot.update_sent = None
+            move_count = unpack_update_res(header)[0]
+            self.counts['moves_received'] += move_count
+            for i in range(0, move_count * MOVE_LEN, MOVE_LEN):
+                sent = self.sent_moves.get(body[i:i + MOVE_LEN])
+                # only moves another bot made after this one joined count towards fan-out
+                if sent != None and sent[0] != bot.slot and sent[1] >= bot.joined:
+                    self.latency['fanout'].append(now - sent[1])
+                    self.counts['fanout'] += 1
+
+
+    def run(self):
+        args = self.args
+        if args.replay:
+            for event in self.events:
+                data = event.get('data')
+                self.schedule(self.start + event['t'], event['bot'], event['op'],
+                              tuple(data) if data != None else None)
+        else:
+            for slot in range(args.bots):
+                self.schedule(self.start + args.ramp * slot / args.bots, slot, 'join')
+        if args.record:
+            self.trace = open(args.record, 'w')
+
+        cpu_start = cpu_seconds(args.server_pid) if args.server_pid else None
+        end = self.start + args.duration
+        while True:
+            now = time.time()
+            if now >= end:
+                break
+            timeout = min(end, self.timers[0][0]) - now if self.timers else end - now
+            for key, events in self.selector.select(max(0, timeout)):
+                bot = key.data
+                if bot.slot not in self.bots:
+                    continue
+                if events & selectors.EVENT_READ:
+                    self.receive(bot, time.time())
+                if events & selectors.EVENT_WRITE and bot.slot in self.bots:
+                    self.flush(bot)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                t, seq, slot, op, data = heapq.heappop(self.timers)
+                self.run_op(now, slot, op, data)
+            while self.sent_moves and next(iter(self.sent_moves.values()))[1] < now - FANOUT_WINDOW:
+                self.sent_moves.popitem(last=False)
+
+        elapsed = time.time() - self.start
+        cpu_end = cpu_seconds(args.server_pid) if args.server_pid else None
+        for bot in list(self.bots.values()):
+            self.drop(bot)
+        if self.trace != None:
+            self.trace.close()
+
+        report = {
+            'mode': 'replay' if args.replay else 'generate',
+            'duration': elapsed,
+            'bots': args.bots,
+            'counts': self.counts,
+            'throughput': {
+                'moves_sent_per_sec': self.counts['moves_sent'] / elapsed,
+                'updates_per_sec': self.counts['updates'] / elapsed,
+                'moves_fanned_out_per_sec': self.counts['fanout'] / elapsed,
+                'bytes_sent_per_sec': self.counts['bytes_sent'] / elapsed,
+                'bytes_received_per_sec': self.counts['bytes_received'] / elapsed,
+            },
+            'latency': {name: summarize(samples) for name, samples in self.latency.items()},
+            'server_cpu': None,
+        }
+        if cpu_start != None:
+            report['server_cpu'] = {'seconds': cpu_end - cpu_start,
+                                    'percent_of_core': 100 * (cpu_end - cpu_start) / elapsed}
+        return report
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""
+Load a jigsaw server with simulated players speaking the game protocol.
+Latencies are in seconds. Fan-out latency runs from a bot sending a move
+to another bot receiving it in an update, so it includes the update interval.
+
+    Run 200 bots for a minute against a local server, measuring its CPU:
+
+        python3 loadgen.py 7777 -b 200 -t 60 --server-pid $(pgrep -f "server.py 7777")
+
+    Record a session, then replay it against another server:
+
+        python3 loadgen.py 7777 -b 50 --record session.jsonl
+        python3 loadgen.py 7778 --replay session.jsonl""")
+
+    parser.add_argument('port', help="Port of the server", type=int)
+    parser.add_argument('-a', '--host', help="Host of the server (default=localhost)",
+                        default="localhost")
+    parser.add_argument('-r', '--room', help=f"Room to join (default={DEFAULT_ROOM})",
+                        default=DEFAULT_ROOM)
+    parser.add_argument('-b', '--bots', help="Simulated players (default=100, or as many as a replayed trace had)",
+                        type=int, default=100)
+    parser.add_argument('-t', '--duration', help="Seconds to run for (default=30, or the length of a replayed trace)",
+                        type=float, default=30)
+    parser.add_argument('-m', '--move-rate', help="Moves per second per bot (default=0.5)",
+                        metavar='HZ', type=float, default=0.5)
+    parser.add_argument('-u', '--cursor-rate', help="Cursor updates per second per bot (default=30)",
+                        metavar='HZ', type=float, default=30)
+    parser.add_argument('-c', '--churn', help="Bots leaving, and being replaced, per second (default=0)",
+                        metavar='HZ', type=float, default=0)
+    parser.add_argument('--ramp', help="Seconds over which the bots first join (default=2)",
+                        type=float, default=2)
+    parser.add_argument('--image-resolution', help="Resolution of the image each bot downloads (default=1, the smallest served)",
+                        metavar='RESOLUTION', type=int, default=1)
+    parser.add_argument('--server-pid', help="Report the CPU time of this server process and its workers",
+                        metavar='PID', type=int, default=None)
+    parser.add_argument('--record', help="Write the session's joins, leaves, moves and cursor updates to a trace",
+                        metavar='FILE', default=None)
+    parser.add_argument('--replay', help="Play back a recorded trace instead of generating load",
+                        metavar='FILE', default=None)
+    parser.add_argument('-o', '--output', help="Write the JSON report to a file instead of stdout",
+                        metavar='FILE', default=None)
+    parser.add_argument('--seed', help="Random seed, for comparable runs (default=0)",
+                        type=int, default=0)
+    args = parser.parse_args()
+
+    if args.bots < 1 or args.duration <= 0 or args.cursor_rate <= 0:
+        print("Error: Bot count, duration and cursor rate must be positive")
+        sys.exit(1)
+    if args.move_rate < 0 or args.churn < 0:
+        print("Error: Move rate and churn can't be negative")
+        sys.exit(1)
+
+    events = None
+    if args.replay:
+        # a replay runs as long as, and with as many bots as, the session it recorded
+        try:
+            events, args.duration, args.bots = read_trace(args.replay)
+        except (OSError, ValueError, KeyError) as exc:
+            print(f"Error: Could not read trace '{args.replay}': {exc}")
+            sys.exit(1)
+        if args.bots < 1:
+            print(f"Error: Trace '{args.replay}' has no bots joining")
+            sys.exit(1)
+
+    random.seed(args.seed)
+    report = Load(args, events).run()
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+    else:
+        json.dump(report, sys.stdout, indent=2)
+
+
+if __name__ == "__main__":
+    main()
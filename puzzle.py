@@ -1,17 +1,54 @@
+from collections import OrderedDict, deque
+import copy
+from math import log2
 import os
 from PIL import Image
+import numpy as np
 os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
 import pygame as pg
-import random
+import time
 
 from common import *
+from tiled import TiledImage
 
 
-def rect_overlap(r1, r2):
-    return (r1[0] < r2[0] + r2[2] and
-            r1[0] + r1[2] > r2[0] and
-            r1[1] < r2[1] + r2[3] and
-            r1[1] + r1[3] > r2[1])
+def randrange(lo, hi, n):
+    return np.random.randint(np.asarray(lo).astype(int), np.asarray(hi).astype(int), size=n)
+
+
+def box_size(box):
+    # the size PIL gives a crop of this box
+    x0, y0, x1, y1 = map(int, map(round, box))
+    return x1 - x0, y1 - y0
+
+
+class SurfaceCache():
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.surfaces = OrderedDict()
+
+
+    def get(self, key):
+        surf = self.surfaces.get(key)
+        if surf != None:
+            self.surfaces.move_to_end(key)
+        return surf
+
+
+    def put(self, key, surf):
+        self.discard(key)
+        self.surfaces[key] = surf
+        self.bytes += surf.get_width() * surf.get_height() * surf.get_bytesize()
+        # always keep the newest surface, even if it alone is over budget
+        while self.bytes > self.max_bytes and len(self.surfaces) > 1:
+            self.discard(next(iter(self.surfaces)))
+
+
+    def discard(self, key):
+        surf = self.surfaces.pop(key, None)
+        if surf != None:
+            self.bytes -= surf.get_width() * surf.get_height() * surf.get_bytesize()
 
 
 class Piece():
@@ -33,19 +70,78 @@ class Piece():
     TRE = 14  # top right corner even
     BLE = 15  # bottom left corner even
 
-
-    def __init__(self, img, crop, ptype, row, col, x_ext, y_ext):
-        self.sprite = pg.image.fromstring(img.tobytes("raw", 'RGBA'), img.size, 'RGBA')
-        self.crop = pg.image.fromstring(crop.tobytes("raw", 'RGB'), crop.size, 'RGB')
-        self.w, self.h = img.size
+    # types whose sprite extends past the piece's left or top edge
+    X_EXT_TYPES = (TRC, BRC, BEE, TEE, ROE, MID)
+    Y_EXT_TYPES = (BOE, REE, LEE, MDR, BLE)
+
+    # mask image and transposes that give each type its shape
+    SHAPES = {
+        TLC: ("corner", ()),
+        TRC: ("corner", (Image.FLIP_LEFT_RIGHT,)),
+        BLC: ("corner", (Image.FLIP_TOP_BOTTOM,)),
+        BRC: ("corner", (Image.FLIP_LEFT_RIGHT, Image.FLIP_TOP_BOTTOM)),
+        BEE: ("even_edge", (Image.FLIP_TOP_BOTTOM,)),
+        TEE: ("even_edge", ()),
+        BOE: ("odd_edge", (Image.FLIP_TOP_BOTTOM,)),
+        TOE: ("odd_edge", ()),
+        ROE: ("odd_edge", (Image.ROTATE_270,)),
+        LOE: ("odd_edge", (Image.ROTATE_90,)),
+        REE: ("even_edge", (Image.ROTATE_270,)),
+        LEE: ("even_edge", (Image.ROTATE_90,)),
+        MID: ("middle", ()),
+        MDR: ("middle", (Image.ROTATE_90,)),
+        TRE: ("corner", (Image.ROTATE_270,)),
+        BLE: ("corner", (Image.ROTATE_90,)),
+    }
+
+    # state lives in the puzzle's arrays, indexed by id
+    __slots__ = ('puzzle', 'id', 'ptype', 'row', 'col')
+
+
+    def __init__(self, puzzle, idx, ptype, row, col):
+        self.puzzle, self.id = puzzle, idx
         self.ptype = ptype
         self.row, self.col = row, col
-        self.x_ext, self.y_ext = x_ext, y_ext
-        self.x, self.y = 0, 0
-        self.disp_x, self.disp_y = 0, 0
-        self.group = set([self])
-        self.locked = False
-        self.adj = None
+
+
+    @property
+    def x(self):
+        return self.puzzle.pos[self.id, 0]
+
+
+    @property
+    def y(self):
+        return self.puzzle.pos[self.id, 1]
+
+
+    @property
+    def disp_x(self):
+        return self.puzzle.disp[self.id, 0]
+
+
+    @property
+    def disp_y(self):
+        return self.puzzle.disp[self.id, 1]
+
+
+    @property
+    def w(self):
+        return self.puzzle.size[self.id, 0]
+
+
+    @property
+    def h(self):
+        return self.puzzle.size[self.id, 1]
+
+
+    @property
+    def locked(self):
+        return self.puzzle.locked[self.id]
+
+
+    @property
+    def group(self):
+        return set(self.puzzle.pieces[i] for i in self.puzzle.group_ids(self))
 
 
     def spos(self):
@@ -53,27 +149,22 @@ class Piece():
 
     
     def sx(self):
-        if self.ptype in (self.TRC, self.BRC, self.BEE,
-                          self.TEE, self.ROE, self.MID):
-            return self.disp_x - self.x_ext
-        else:
-            return self.disp_x
+        return self.disp_x - self.puzzle.offset[self.id, 0]
 
 
     def sy(self):
-        if self.ptype in (self.BOE, self.REE, self.LEE,
-                          self.MDR, self.BLE):
-            return self.disp_y - self.y_ext
-        else:
-            return self.disp_y
+        return self.disp_y - self.puzzle.offset[self.id, 1]
         
 
     def place(self):
-        self.disp_x, self.disp_y = self.x, self.y
+        self.puzzle.disp[self.id] = self.puzzle.pos[self.id]
 
 
 class Puzzle():
-    def __init__(self, img, width, height, downscale=-1, margin=2):
+    # coarsest level of detail, in halvings of full resolution
+    max_level = 5
+
+    def __init__(self, img, width, height, downscale=-1, margin=2, cache_bytes=256 * 2**20):
         if width <= 1 or height <= 1:
             raise ValueError("Puzzle dimensions must be greater than 1")
         img_w, img_h = img.size
@@ -106,6 +197,36 @@ class Puzzle():
         self.piece_w, self.piece_h = piece_w, piece_h
         self.connect_tol = min(piece_w, piece_h) / 5
 
+        n = width * height
+        self.pos = np.zeros((n, 2))
+        self.disp = np.zeros((n, 2))
+        self.size = np.zeros((n, 2))
+        self.offset = np.zeros((n, 2))
+        self.boxes = np.zeros((n, 4))
+        self.locked = np.zeros(n, dtype=bool)
+        self.landlocked = np.zeros(n, dtype=bool)
+        self.gid = np.arange(n)
+        self.z = np.arange(n)
+        self.ztop = n
+
+        # ids of the up/down/left/right neighbors, -1 at the puzzle's edges
+        ids = np.arange(n).reshape(height, width)
+        self.neighbors = np.full((height, width, 4), -1)
+        self.neighbors[1:, :, 0] = ids[:-1, :]
+        self.neighbors[:-1, :, 1] = ids[1:, :]
+        self.neighbors[:, 1:, 2] = ids[:, :-1]
+        self.neighbors[:, :-1, 3] = ids[:, 1:]
+        self.neighbors = self.neighbors.reshape(n, 4)
+
+        # piece surfaces are cut from the image on demand
+        self.cache = SurfaceCache(cache_bytes)
+        self.masks = {}
+        self.level = self.max_level
+        self.to_cut = deque()
+        # rendering work since the frame stats last read them
+        self.counters = dict.fromkeys(('blitted', 'culled', 'placeholders', 'scaled', 'cut'), 0)
+        self.pending = np.zeros(n, dtype=bool)
+
         self.pieces = []
         self.matrix = {}
         for r in range(height):
@@ -113,169 +234,244 @@ class Puzzle():
                 if r == 0 and c == 0:
                     # top left corner
                     ptype = Piece.TLC
-                    base = Image.open("corner.png")
-                    mask = Image.open("corner_blur.png")
-                    crop = img.crop((0, 0, piece_w + x_ext, piece_h))
+                    box = (0, 0, piece_w + x_ext, piece_h)
                 elif r == 0 and c == width - 1:
                     # top right corner
                     if width % 2 == 0:
                         ptype = Piece.TRE
-                        base = Image.open("corner.png").transpose(Image.ROTATE_270)
-                        mask = Image.open("corner_blur.png").transpose(Image.ROTATE_270)
-                        crop = img.crop((img_w - piece_w, 0, img_w, piece_h + y_ext))
+                        box = (img_w - piece_w, 0, img_w, piece_h + y_ext)
                     else:
                         ptype = Piece.TRC
-                        base = Image.open("corner.png").transpose(Image.FLIP_LEFT_RIGHT)
-                        mask = Image.open("corner_blur.png").transpose(Image.FLIP_LEFT_RIGHT)
-                        crop = img.crop((img_w - piece_w - x_ext, 0, img_w, piece_h))
+                        box = (img_w - piece_w - x_ext, 0, img_w, piece_h)
                 elif r == height - 1 and c == 0:
                     # bottom left corner
                     if height % 2 == 0:
                         ptype = Piece.BLE
-                        base = Image.open("corner.png").transpose(Image.ROTATE_90)
-                        mask = Image.open("corner_blur.png").transpose(Image.ROTATE_90)
-                        crop = img.crop((0, img_h - piece_h - y_ext, piece_w, img_h))
+                        box = (0, img_h - piece_h - y_ext, piece_w, img_h)
                     else:
                         ptype = Piece.BLC
-                        base = Image.open("corner.png").transpose(Image.FLIP_TOP_BOTTOM)
-                        mask = Image.open("corner_blur.png").transpose(Image.FLIP_TOP_BOTTOM)
-                        crop = img.crop((0, img_h - piece_h, piece_w + x_ext, img_h))
+                        box = (0, img_h - piece_h, piece_w + x_ext, img_h)
                 elif r == height - 1 and c == width - 1:
                     # bottom right corner
                     ptype = Piece.BRC
-                    base = Image.open("corner.png").transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.FLIP_TOP_BOTTOM)
-                    mask = Image.open("corner_blur.png").transpose(Image.FLIP_LEFT_RIGHT).transpose(Image.FLIP_TOP_BOTTOM)
-                    crop = img.crop((img_w - piece_w - x_ext, img_h - piece_h, img_w, img_h))
+                    box = (img_w - piece_w - x_ext, img_h - piece_h, img_w, img_h)
                 elif r == 0 or r == height - 1:
                     # horizontal edge
                     if bool(c % 2 == 0) ^ bool(height % 2 == 0 and r == height - 1):
-                        base = Image.open("even_edge.png")
-                        mask = Image.open("even_edge_blur.png")
                         if r == height - 1:
                             # bottom edge
                             ptype = Piece.BEE
-                            base = base.transpose(Image.FLIP_TOP_BOTTOM)
-                            mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
-                            crop = img.crop((c * piece_w - x_ext, img_h - piece_h, (c + 1) * piece_w + x_ext, img_h))
+                            box = (c * piece_w - x_ext, img_h - piece_h, (c + 1) * piece_w + x_ext, img_h)
                         else:
                             # top edge
                             ptype = Piece.TEE
-                            crop = img.crop((c * piece_w - x_ext, 0, (c + 1) * piece_w + x_ext, piece_h))
+                            box = (c * piece_w - x_ext, 0, (c + 1) * piece_w + x_ext, piece_h)
                     else:
-                        base = Image.open("odd_edge.png")
-                        mask = Image.open("odd_edge_blur.png")
                         if r == height - 1:
                             # bottom edge
                             ptype = Piece.BOE
-                            base = base.transpose(Image.FLIP_TOP_BOTTOM)
-                            mask = mask.transpose(Image.FLIP_TOP_BOTTOM)
-                            crop = img.crop((c * piece_w, img_h - piece_h - y_ext, (c + 1) * piece_w, img_h))
+                            box = (c * piece_w, img_h - piece_h - y_ext, (c + 1) * piece_w, img_h)
                         else:
                             # top edge
                             ptype = Piece.TOE
-                            crop = img.crop((c * piece_w, 0, (c + 1) * piece_w, piece_h + y_ext))
+                            box = (c * piece_w, 0, (c + 1) * piece_w, piece_h + y_ext)
                 elif c == 0 or c == width - 1:
                     # vertical edge (switch odd and even edges)
                     if bool(r % 2 == 0) ^ bool(width % 2 == 0 and c == width - 1):
-                        base = Image.open("odd_edge.png")
-                        mask = Image.open("odd_edge_blur.png")
                         if c == width - 1:
                             # right edge
                             ptype = Piece.ROE
-                            base = base.transpose(Image.ROTATE_270)
-                            mask = mask.transpose(Image.ROTATE_270)
-                            crop = img.crop((img_w - piece_w - x_ext, r * piece_h, img_w, (r + 1) * piece_h))
+                            box = (img_w - piece_w - x_ext, r * piece_h, img_w, (r + 1) * piece_h)
                         else:
                             # left edge
                             ptype = Piece.LOE
-                            base = base.transpose(Image.ROTATE_90)
-                            mask = mask.transpose(Image.ROTATE_90)
-                            crop = img.crop((0, r * piece_h, piece_w + x_ext, (r + 1) * piece_h))
+                            box = (0, r * piece_h, piece_w + x_ext, (r + 1) * piece_h)
                     else:
-                        base = Image.open("even_edge.png")
-                        mask = Image.open("even_edge_blur.png")
                         if c == width - 1:
                             # right edge
                             ptype = Piece.REE
-                            base = base.transpose(Image.ROTATE_270)
-                            mask = mask.transpose(Image.ROTATE_270)
-                            crop = img.crop((img_w - piece_w, r * piece_h - y_ext, img_w, (r + 1) * piece_h + y_ext))
+                            box = (img_w - piece_w, r * piece_h - y_ext, img_w, (r + 1) * piece_h + y_ext)
                         else:
                             # left edge
                             ptype = Piece.LEE
-                            base = base.transpose(Image.ROTATE_90)
-                            mask = mask.transpose(Image.ROTATE_90)
-                            crop = img.crop((0, r * piece_h - y_ext, piece_w, (r + 1) * piece_h + y_ext))
+                            box = (0, r * piece_h - y_ext, piece_w, (r + 1) * piece_h + y_ext)
                 elif r % 2 == c % 2:
                     ptype = Piece.MID
-                    base = Image.open("middle.png")
-                    mask = Image.open("middle_blur.png")
-                    crop = img.crop((c * piece_w - x_ext, r * piece_h,
-                                    (c + 1) * piece_w + x_ext, (r + 1) * piece_h))
+                    box = (c * piece_w - x_ext, r * piece_h,
+                           (c + 1) * piece_w + x_ext, (r + 1) * piece_h)
                 else:
                     ptype = Piece.MDR
-                    base = Image.open("middle.png").transpose(Image.ROTATE_90)
-                    mask = Image.open("middle_blur.png").transpose(Image.ROTATE_90)
-                    crop = img.crop((c * piece_w, r * piece_h - y_ext,
-                                    (c + 1) * piece_w, (r + 1) * piece_h + y_ext))
-
-                base = base.resize(crop.size)
-                mask = mask.resize(crop.size)
-                piece = Piece(Image.composite(crop, base, mask), crop, ptype, r, c, x_ext, y_ext)
+                    box = (c * piece_w, r * piece_h - y_ext,
+                           (c + 1) * piece_w, (r + 1) * piece_h + y_ext)
+
+                piece = Piece(self, len(self.pieces), ptype, r, c)
+                self.boxes[piece.id] = box
+                self.size[piece.id] = box_size(box)
                 self.pieces.append(piece)
                 self.matrix[(r, c)] = piece
 
-                if random.choice([True, False]):
-                    piece.x = random.choice([random.randrange(int(img_w / 2), int(self.origin_x - piece.w)),
-                                            random.randrange(int(self.origin_x + img_w + piece.x - piece.sx()),
-                                                             int(self.w - img_w / 2))])
-                    piece.y = random.randrange(int(img_h / 2), int(self.h - img_h / 2))
-                else:
-                    piece.y = random.choice([random.randrange(int(img_h / 2), int(self.origin_y - piece.h)),
-                                            random.randrange(int(self.origin_y + img_h + piece.y - piece.sy()),
-                                                             int(self.h - img_h / 2))])
-                    piece.x = random.randrange(int(img_w / 2), int(self.w - img_w / 2))
-                piece.place()
+        ptypes = np.array([p.ptype for p in self.pieces])
+        self.offset[:, 0] = np.where(np.isin(ptypes, Piece.X_EXT_TYPES), x_ext, 0)
+        self.offset[:, 1] = np.where(np.isin(ptypes, Piece.Y_EXT_TYPES), y_ext, 0)
+        self.scatter()
+
+        # pieces whose part of a still downloading image hasn't arrived
+        if isinstance(img, TiledImage) and not img.complete():
+            self.last_tiles = img.last_tiles(self.boxes)
+            self.pending[:] = self.last_tiles >= img.available()
+
+
+    def mask(self, ptype, size):
+        key = (ptype, size)
+        if key not in self.masks:
+            name, ops = Piece.SHAPES[ptype]
+            base = Image.open(name + ".png")
+            mask = Image.open(name + "_blur.png")
+            for op in ops:
+                base = base.transpose(op)
+                mask = mask.transpose(op)
+            self.masks[key] = (base.resize(size), mask.resize(size))
+        return self.masks[key]
+
+
+    def cut(self, i, level):
+        crop = self.img.crop(tuple(self.boxes[i]))
+        if level > 0:
+            crop = crop.resize((max(1, crop.size[0] >> level), max(1, crop.size[1] >> level)))
+        if self.landlocked[i]:
+            # fully surrounded pieces need no outline
+            surf = pg.image.fromstring(crop.tobytes("raw", 'RGB'), crop.size, 'RGB')
+            return surf.convert() if pg.display.get_surface() != None else surf
+        base, mask = self.mask(self.pieces[i].ptype, crop.size)
+        sprite = Image.composite(crop, base, mask)
+        return pg.image.fromstring(sprite.tobytes("raw", 'RGBA'), sprite.size, 'RGBA')
+
+
+    def surface(self, i, level=0):
+        surf = self.cache.get((i, level))
+        if surf == None:
+            surf = self.cut(i, level)
+            self.cache.put((i, level), surf)
+            self.counters['cut'] += 1
+        return surf
+
+
+    def poll_source(self, budget):
+        if self.pending.any():
+            self.img.scan()
+            arrived = np.flatnonzero(self.pending & (self.last_tiles < self.img.available()))
+            self.pending[arrived] = False
+            self.to_cut.extend(arrived.tolist())
+
+        # cut pieces as their part of the image arrives, for up to budget seconds
+        end = time.perf_counter() + budget
+        while self.to_cut and time.perf_counter() < end:
+            self.surface(self.to_cut.popleft(), self.level)
+
+
+    def detail_level(self, scale):
+        # the smallest surface that still only ever gets scaled down
+        if scale >= 1:
+            return 0
+        return min(int(log2(1 / scale)), self.max_level)
+
+
+    def scatter(self):
+        n = len(self.pieces)
+        img_w, img_h = self.img_w, self.img_h
+        w, h = self.size[:, 0], self.size[:, 1]
+        ox, oy = self.offset[:, 0], self.offset[:, 1]
+
+        # either beside the board horizontally or vertically, on a random side
+        horizontal = np.random.random(n) < 0.5
+        before = np.random.random(n) < 0.5
+        side_x = np.where(before,
+                          randrange(img_w / 2, self.origin_x - w, n),
+                          randrange(self.origin_x + img_w + ox, self.w - img_w / 2, n))
+        side_y = np.where(before,
+                          randrange(img_h / 2, self.origin_y - h, n),
+                          randrange(self.origin_y + img_h + oy, self.h - img_h / 2, n))
+        self.pos[:, 0] = np.where(horizontal, side_x, randrange(img_w / 2, self.w - img_w / 2, n))
+        self.pos[:, 1] = np.where(horizontal, randrange(img_h / 2, self.h - img_h / 2, n), side_y)
+        self.disp[:] = self.pos
+
+    
+    def copy(self):
+        # shares geometry and the source image, but not piece state or surfaces
+        other = copy.copy(self)
+        for name in ('pos', 'disp', 'locked', 'landlocked', 'gid', 'z', 'pending'):
+            setattr(other, name, getattr(self, name).copy())
+        other.pieces = [Piece(other, p.id, p.ptype, p.row, p.col) for p in self.pieces]
+        other.matrix = {(p.row, p.col): p for p in other.pieces}
+        other.cache = SurfaceCache(self.cache.max_bytes)
+        other.to_cut = deque()
+        other.counters = dict.fromkeys(self.counters, 0)
+        return other
+
+
+    def to_board(self, x, y):
+        # resolution independent coordinates, in image widths and heights
+        return x / self.img_w, y / self.img_h
+
+
+    def from_board(self, x, y):
+        return x * self.img_w, y * self.img_h
 
     
+    def group_ids(self, piece):
+        return np.flatnonzero(self.gid == self.gid[piece.id])
+
+
+    def raise_ids(self, ids):
+        # bring to the front, keeping their stacking order among themselves
+        ids = ids[np.argsort(self.z[ids])]
+        self.z[ids] = np.arange(self.ztop, self.ztop + len(ids))
+        self.ztop += len(ids)
+
+
     def click_check(self, x, y):
-        for i in range(len(self.pieces) - 1, -1, -1):
-            p = self.pieces[i]
-            if (not p.locked and
-                p.disp_x < x < p.disp_x + self.piece_w and
-                p.disp_y < y < p.disp_y + self.piece_h):
-                self.pieces.pop(i)
-                self.pieces.append(p)
-                return p
-        return None
+        dx, dy = self.disp[:, 0], self.disp[:, 1]
+        hit = np.flatnonzero(~self.locked &
+                             (dx < x) & (x < dx + self.piece_w) &
+                             (dy < y) & (y < dy + self.piece_h))
+        if len(hit) == 0:
+            return None
+        i = hit[np.argmax(self.z[hit])]
+        self.raise_ids(np.array([i]))
+        return self.pieces[i]
 
     
     def move_piece(self, piece, dx, dy):
         if piece.locked: return
-        for p in piece.group:
-            if p.sx() + dx < 0 or p.sx() + dx + p.w > self.w:
-                dx = 0
-            if p.sy() + dy < 0 or p.sy() + dy + p.h > self.h:
-                dy = 0
-            if dx == 0 and dy == 0:
-                break
-        for p in piece.group:
-            p.disp_x += dx
-            p.disp_y += dy
-            self.pieces.remove(p)
-            self.pieces.append(p)
+        ids = self.group_ids(piece)
+        spos = self.disp[ids] - self.offset[ids]
+        lo = spos.min(axis=0)
+        hi = (spos + self.size[ids]).max(axis=0)
+        if lo[0] + dx < 0 or hi[0] + dx > self.w:
+            dx = 0
+        if lo[1] + dy < 0 or hi[1] + dy > self.h:
+            dy = 0
+        self.disp[ids] += (dx, dy)
+        self.raise_ids(ids)
 
 
     def place_piece(self, piece, x, y):
         if piece.locked: return
-        dx = x - piece.x
-        dy = y - piece.y
-        for p in piece.group:
-            p.x += dx
-            p.y += dy
-            p.place()
-            self.pieces.remove(p)
-            self.pieces.append(p)
+        d = (x - piece.x, y - piece.y)
+        ids = self.group_ids(piece)
+        self.pos[ids] += d
+        self.disp[ids] = self.pos[ids]
+        self.raise_ids(ids)
+
+
+    def visible_ids(self, ss_x, ss_y, ss_width, ss_height):
+        spos = self.disp - self.offset
+        x, y = spos[:, 0], spos[:, 1]
+        w, h = self.size[:, 0], self.size[:, 1]
+        ids = np.flatnonzero((x < ss_x + ss_width) & (x + w > ss_x) &
+                             (y < ss_y + ss_height) & (y + h > ss_y))
+        # locked pieces underneath, then by stacking order
+        return ids[np.lexsort((self.z[ids], ~self.locked[ids]))]
             
     
     def subsurface(self, ss_x, ss_y, ss_width, ss_height, scale):
@@ -291,42 +487,53 @@ class Puzzle():
         if rw > 0 and rh > 0:
             pg.draw.rect(frame, BLACK, (int(rx * scale), int(ry * scale), int(rw * scale), int(rh * scale)))
 
-        for p in self.pieces:
-            if not p.locked: continue
-            if rect_overlap((ss_x, ss_y, ss_width, ss_height), (p.sx(), p.sy(), p.w, p.h)):
-                frame.blit(pg.transform.scale(p.sprite, (int(p.w * scale), int(p.h * scale))),
-                        (int((p.sx() - ss_x) * scale), int((p.sy() - ss_y) * scale)))
-
-        for p in self.pieces:
-            if p.locked: continue
-            if rect_overlap((ss_x, ss_y, ss_width, ss_height), (p.sx(), p.sy(), p.w, p.h)):
-                frame.blit(pg.transform.scale(p.sprite, (int(p.w * scale), int(p.h * scale))),
-                        (int((p.sx() - ss_x) * scale), int((p.sy() - ss_y) * scale)))
-
+        self.level = level = self.detail_level(scale)
+        ids = self.visible_ids(ss_x, ss_y, ss_width, ss_height)
+        dests = ((self.disp[ids] - self.offset[ids] - (ss_x, ss_y)) * scale).astype(int)
+        dims = (self.size[ids] * scale).astype(int)
+        scaled = 0
+        for i, dest, dim in zip(ids.tolist(), dests.tolist(), dims.tolist()):
+            if self.pending[i]:
+                pg.draw.rect(frame, GRAY, dest + dim)
+                continue
+            surf = self.surface(i, level)
+            if surf.get_size() != tuple(dim):
+                surf = pg.transform.scale(surf, dim)
+                scaled += 1
+            frame.blit(surf, dest)
+
+        counters = self.counters
+        placeholders = int(self.pending[ids].sum()) if self.pending.any() else 0
+        counters['blitted'] += len(ids) - placeholders
+        counters['placeholders'] += placeholders
+        counters['culled'] += len(self.pieces) - len(ids)
+        counters['scaled'] += scaled
         return frame
 
 
     def complete(self):
-        return len(self.pieces[0].group) == self.width * self.height
+        return (self.gid == self.gid[0]).all()
 
         
-    def landlock_check(self, piece):
-        if piece.adj == None:
-            piece.adj = set()
-            neighbors = [self.matrix.get((piece.row - 1, piece.col), None),
-                         self.matrix.get((piece.row + 1, piece.col), None),
-                         self.matrix.get((piece.row, piece.col - 1), None),
-                         self.matrix.get((piece.row, piece.col + 1), None)]
-            for n in neighbors:
-                if n != None:
-                    piece.adj.add(n)
-        if piece.adj.issubset(piece.group):
-            piece.sprite = piece.crop.convert()
+    def landlock_check(self, ids):
+        nbr = self.neighbors[ids]
+        inside = (nbr == -1) | (self.gid[nbr] == self.gid[ids, None])
+        for i in ids[inside.all(axis=1) & ~self.landlocked[ids]].tolist():
+            self.landlocked[i] = True
+            for level in range(self.max_level + 1):
+                self.cache.discard((i, level))
+
+
+    def merge_groups(self, piece, other):
+        ids = np.flatnonzero((self.gid == self.gid[piece.id]) | (self.gid == self.gid[other.id]))
+        self.gid[ids] = self.gid[piece.id]
+        self.locked[ids] = piece.locked or other.locked
+        self.landlock_check(ids)
 
 
     def connection_check(self, piece):
-        for p in piece.group:
-            self.single_connection_check(p)
+        for i in self.group_ids(piece).tolist():
+            self.single_connection_check(self.pieces[i])
 
 
     def single_connection_check(self, piece):
@@ -338,34 +545,28 @@ class Puzzle():
                     self.place_piece(other, other.x - dx, other.y - dy)
                 else:
                     self.place_piece(piece, tx, ty)
-                new_group = piece.group.union(other.group)
-                locked = piece.locked or other.locked
-                for p in new_group:
-                    p.group = new_group
-                    p.locked = locked
-                    self.landlock_check(p)
+                self.merge_groups(piece, other)
 
         n = self.matrix.get((piece.row - 1, piece.col), None)
-        if n != None and n not in piece.group:
+        if n != None and self.gid[n.id] != self.gid[piece.id]:
             check_single(n, n.x, n.y + self.piece_h)
 
         n = self.matrix.get((piece.row, piece.col - 1), None)
-        if n != None and n not in piece.group:
+        if n != None and self.gid[n.id] != self.gid[piece.id]:
             check_single(n, n.x + self.piece_w, n.y)
 
         n = self.matrix.get((piece.row + 1, piece.col), None)
-        if n != None and n not in piece.group:
+        if n != None and self.gid[n.id] != self.gid[piece.id]:
             check_single(n, n.x, n.y - self.piece_h)
 
         n = self.matrix.get((piece.row, piece.col + 1), None)
-        if n != None and n not in piece.group:
+        if n != None and self.gid[n.id] != self.gid[piece.id]:
             check_single(n, n.x - self.piece_w, n.y)
         
         def check_corner(dx, dy):
             if abs(dx) < self.connect_tol and abs(dy) < self.connect_tol:
                 self.place_piece(piece, piece.x + dx, piece.y + dy)
-                for p in piece.group:
-                    p.locked = True
+                self.locked[self.group_ids(piece)] = True
 
         if piece.row == 0:
             if piece.col == 0:
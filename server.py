@@ -1,85 +1,634 @@
-from PIL import Image
+import argparse
+import json
+import multiprocessing as mp
+from multiprocessing import reduction
+import numpy as np
+import os
 import select
+import signal
 import socket
 import sys
+import threading
+import time
+if sys.platform.startswith('linux'):
+    # for reading how much a client has yet to acknowledge
+    import fcntl
+    import termios
 
 from common import *
+from journal import Journal, MOVE_DTYPE
 from puzzle import Puzzle
+from tiled import open_image
 
 
-def main():
-    port = int(sys.argv[1])
-    img_path = sys.argv[2]
-    W = int(sys.argv[3])
-    H = int(sys.argv[4])
+MIN_LEVEL_DIM = 512
+# seconds a new client has to say which room it wants
+HANDSHAKE_TIMEOUT = 5
+MAX_NAME_LEN = 1024
+
+REQ_NAMES = {IDX_REQ: 'idx', IMG_REQ: 'img', INIT_REQ: 'init', UPDATE_REQ: 'update', MOVE_REQ: 'move'}
+
+
+def build_pyramid(img):
+    levels = [img]
+    while max(levels[-1].size) // 2 >= MIN_LEVEL_DIM:
+        w, h = levels[-1].size
+        levels.append(levels[-1].resize((w // 2, h // 2)))
+    # only the levels' files are served, so the tiles decoded to build them are dead weight;
+    # the source's are left to the caller, as in host mode it is the host's puzzle image too
+    for level in levels[1:]:
+        level.drop_tiles()
+    return levels
+
+
+def pick_level(levels, max_dim):
+    # the smallest level that still covers the requested resolution
+    if max_dim == 0:
+        return levels[0]
+    for level in reversed(levels):
+        if max(level.size) >= max_dim:
+            return level
+    return levels[0]
+
+
+def recv_name(sock, name_len=None):
+    if name_len == None:
+        name_len = unpack_room_len(sock.recv(ROOM_LEN, socket.MSG_WAITALL))[0]
+    return sock.recv(name_len, socket.MSG_WAITALL).decode() if name_len else ""
+
+
+def hand_off(chan, sock, name, pid):
+    # pass a client socket and its room name to the worker on the other end of chan
+    chan.sendall(pack_room_req(name))
+    if sys.platform == 'win32':
+        data = sock.share(pid)
+        chan.sendall(struct.pack(ROOM_FMT, len(data)) + data)
+    else:
+        reduction.sendfds(chan, [sock.fileno()])
+    sock.close()
+
+
+def take_over(chan):
+    msg = chan.recv(ROOM_LEN, socket.MSG_WAITALL)
+    if not msg:
+        return None
+    name = recv_name(chan, unpack_room_len(msg)[0])
+    if sys.platform == 'win32':
+        data_len = unpack_room_len(chan.recv(ROOM_LEN, socket.MSG_WAITALL))[0]
+        sock = socket.fromshare(chan.recv(data_len, socket.MSG_WAITALL))
+    else:
+        sock = socket.socket(fileno=reduction.recvfds(chan, 1)[0])
+    return name, sock
+
+
+def send_backlog(sock):
+    # bytes written to a client that it hasn't acknowledged yet, where the platform reports it
+    if not sys.platform.startswith('linux'):
+        return None
+    return struct.unpack("i", fcntl.ioctl(sock.fileno(), termios.TIOCOUTQ, bytes(4)))[0]
+
+
+class ClientStats():
+    def __init__(self, idx, addr):
+        self.idx = idx
+        self.addr = addr
+        self.connected = time.time()
+        self.bytes_in, self.bytes_out = 0, 0
+        self.requests = dict.fromkeys(REQ_NAMES.values(), 0)
+        # request counts as of the last report, for rates between reports
+        self.reported = dict(self.requests)
+        self.last_update = None
+
+
+class Room():
+    def __init__(self, name, img, puzzle, journal_dir=None, snapshot_every=500):
+        self.name = name
+        width, height = puzzle.width, puzzle.height
+        self.width, self.height = width, height
+        self.puzzle = puzzle
+        self.levels = build_pyramid(img)
+        self.initial_moves = [Move(p).pack() for p in self.puzzle.pieces]
+        # move numbers count from the start of the session, self.moves starts at base
+        self.moves = []
+        self.base = 0
+        self.snapshot_pos = 0
+        self.snapshot_every = snapshot_every
+        self.clients = {}
+        self.indices = {}
+        self.cursors = {}
+        self.stats = {}
+        self.next_idx = 0
+
+        self.journal = None
+        if journal_dir != None:
+            os.makedirs(journal_dir, exist_ok=True)
+            self.journal = Journal(os.path.join(journal_dir, name), width, height)
+            resumed = self.journal.load()
+            if resumed != None:
+                self.restore(*resumed)
+                print(f"Server: Resumed room '{name}' with {len(self.moves)} move(s) since its last snapshot")
+            else:
+                self.settle()
+                self.snapshot()
+
+
+    def settle(self):
+        # connect pieces the same way clients do after INIT
+        for p in self.puzzle.pieces:
+            self.puzzle.single_connection_check(p)
+
+
+    def valid(self, move):
+        # checked before a move is stored, as a stored move is replayed by every client and on resume
+        if len(move) != MOVE_LEN:
+            return False
+        move = Move().unpack(move)
+        return (move.r, move.c) in self.puzzle.matrix and np.isfinite([move.x, move.y]).all()
+
+
+    def apply(self, move):
+        move = Move().unpack(move)
+        p = self.puzzle.matrix[(move.r, move.c)]
+        self.puzzle.place_piece(p, *self.puzzle.from_board(move.x, move.y))
+        self.puzzle.connection_check(p)
+
+
+    def records(self):
+        n = self.width * self.height
+        records = np.zeros(n, MOVE_DTYPE)
+        records['r'], records['c'] = np.divmod(np.arange(n), self.width)
+        records['x'], records['y'] = self.puzzle.to_board(self.puzzle.pos[:, 0], self.puzzle.pos[:, 1])
+        return records
+
+
+    def restore(self, records, gid, locked, tail):
+        ids = records['r'].astype(int) * self.width + records['c'].astype(int)
+        x, y = self.puzzle.from_board(records['x'], records['y'])
+        self.puzzle.pos[ids, 0], self.puzzle.pos[ids, 1] = x, y
+        self.puzzle.disp[:] = self.puzzle.pos
+        self.puzzle.gid[:] = gid
+        self.puzzle.locked[:] = locked
+        self.initial_moves = [r.tobytes() for r in records]
+        # journals written before moves were checked may hold ones no client could have made
+        tail = [move for move in tail if self.valid(move)]
+        for move in tail:
+            self.apply(move)
+        self.moves = list(tail)
+
+
+    def snapshot(self):
+        records = self.records()
+        self.journal.snapshot(records, self.puzzle.gid, self.puzzle.locked)
+        self.initial_moves = [r.tobytes() for r in records]
+        self.snapshot_pos = self.base + len(self.moves)
+        # forget moves that both new and connected clients are past
+        trim = min([self.snapshot_pos] + list(self.clients.values())) - self.base
+        del self.moves[:trim]
+        self.base += trim
+
+
+    def add_move(self, move):
+        self.moves.append(move)
+        if self.journal != None:
+            self.journal.append(move)
+            self.apply(move)
+            if self.base + len(self.moves) - self.snapshot_pos >= self.snapshot_every:
+                self.snapshot()
+
+
+    def flush(self):
+        if self.journal != None:
+            self.journal.flush()
+
+
+    def close(self):
+        if self.journal != None:
+            self.journal.close()
+
+
+    def join(self, sock):
+        idx = self.next_idx
+        self.next_idx += 1
+        self.clients[sock] = self.snapshot_pos
+        self.indices[sock] = idx
+        self.cursors[idx] = Cursor(idx).pack()
+        try:
+            addr = "%s:%d" % sock.getpeername()[:2]
+        except OSError:
+            addr = None
+        self.stats[sock] = ClientStats(idx, addr)
+        print(f"Server: Client connected to room '{self.name}'")
+
+
+    def leave(self, sock):
+        print(f"Server: Client disconnected from room '{self.name}'")
+        self.clients.pop(sock)
+        self.cursors.pop(self.indices.pop(sock))
+        self.stats.pop(sock)
+
+
+    def handle(self, sock):
+        req = sock.recv(REQ_LEN)
+        if req == bytes():
+            return False
+        if req not in REQ_NAMES:
+            print("Error: unknown request type " + str(req))
+            return True
+        stats = self.stats[sock]
+        stats.requests[REQ_NAMES[req]] += 1
+        stats.bytes_in += len(req)
+
+        # replies go out in one write, as small writes wait on the client's delayed acks
+        reply = bytes()
+        if req == IDX_REQ:
+            reply = pack_idx(self.indices[sock])
+        elif req == IMG_REQ:
+            msg = sock.recv(IMG_REQ_LEN)
+            stats.bytes_in += len(msg)
+            level = pick_level(self.levels, unpack_img_req(msg)[0])
+            size = os.path.getsize(level.path)
+            sock.sendall(pack_img_res(size, self.width, self.height))
+            with open(level.path, 'rb') as f:
+                sock.sendfile(f)
+            stats.bytes_out += IMG_RES_LEN + size
+        elif req == INIT_REQ:
+            # the layout is as of the last snapshot, so updates go on from there rather than from joining
+            self.clients[sock] = self.snapshot_pos
+            reply = pack_init_res(len(self.initial_moves)) + bytes().join(self.initial_moves)
+        elif req == UPDATE_REQ:
+            idx = self.indices[sock]
+            cursor = sock.recv(CURSOR_LEN)
+            stats.bytes_in += len(cursor)
+            stats.last_update = time.time()
+            self.cursors[idx] = cursor
+            cpos = self.clients[sock]
+            end = self.base + len(self.moves)
+            reply = bytes().join([pack_update_res(end - cpos, len(self.cursors) - 1)] +
+                                 self.moves[cpos - self.base:] +
+                                 [c for i, c in self.cursors.items() if i != idx])
+            self.clients[sock] = end
+        elif req == MOVE_REQ:
+            move = sock.recv(MOVE_LEN, socket.MSG_WAITALL)
+            stats.bytes_in += len(move)
+            if not self.valid(move):
+                print(f"Error: invalid move from client {self.indices[sock]} in room '{self.name}'")
+                return False
+            self.add_move(move)
+
+        if reply:
+            sock.sendall(reply)
+            stats.bytes_out += len(reply)
+        return True
+
+
+    def report(self, now, elapsed):
+        end = self.base + len(self.moves)
+        clients = []
+        for sock, stats in self.stats.items():
+            try:
+                backlog = send_backlog(sock)
+            except OSError:
+                backlog = None
+            clients.append({
+                'idx': stats.idx,
+                'addr': stats.addr,
+                'connected_for': now - stats.connected,
+                'bytes_in': stats.bytes_in,
+                'bytes_out': stats.bytes_out,
+                'requests': stats.requests,
+                'request_rates': {name: (count - stats.reported[name]) / elapsed
+                                  for name, count in stats.requests.items()},
+                'since_update': None if stats.last_update == None else now - stats.last_update,
+                'send_backlog': backlog,
+                # moves logged that the client hasn't fetched yet
+                'moves_behind': end - self.clients[sock],
+            })
+            stats.reported = dict(stats.requests)
+        return {'moves': end, 'move_log': len(self.moves), 'snapshot_pos': self.snapshot_pos,
+                'clients': clients}
+
+
+class Worker():
+    def __init__(self, rooms, stats_path=None, stats_interval=5):
+        self.rooms = rooms
+        self.socks = {}
+        self.stats_path = stats_path
+        self.stats_interval = stats_interval
+        self.started = time.time()
+
+
+    def run(self, chan):
+        reported = time.time()
+        tick = reported + self.stats_interval
+        busy, longest, iterations = 0, 0, 0
+        while True:
+            try:
+                timeout = max(0, tick - time.time()) if self.stats_path != None else None
+                ready_to_read, ready_to_write, in_error = \
+                    select.select([chan] + list(self.socks.keys()), [], [], timeout)
+                start = time.time()
 
-    img = Image.open(img_path)
-    puzzle = Puzzle(img, int(W), int(H))
-    moves = []
-    initial_moves = []
-    for p in puzzle.pieces:
-        initial_moves.append(Move(p).pack())
+                for sock in ready_to_read:
+                    if sock == chan:
+                        taken = take_over(chan)
+                        if taken == None:
+                            # the lobby has gone away
+                            self.close()
+                            return
+                        name, csock = taken
+                        self.socks[csock] = self.rooms[name]
+                        self.rooms[name].join(csock)
+                        continue
 
-    img_bytes = pickle.dumps(img)
-    img_res = pack_img_res(len(img_bytes), W, H)
+                    room = self.socks[sock]
+                    try:
+                        connected = room.handle(sock)
+                    except (socket.error, struct.error) as exc:
+                        print("Socket error: " + str(exc))
+                        connected = False
+                    if not connected:
+                        room.leave(sock)
+                        self.socks.pop(sock)
+                        sock.close()
 
+                for room in self.rooms.values():
+                    room.flush()
+
+                now = time.time()
+                busy += now - start
+                longest = max(longest, now - start)
+                iterations += 1
+                if self.stats_path != None and now >= tick:
+                    # how late the loop got around to the report is its lag
+                    loop = {'lag': now - tick, 'busy': busy / (now - reported),
+                            'longest_iteration': longest, 'iterations': iterations}
+                    self.write_stats(now, now - reported, loop)
+                    reported, tick = now, now + self.stats_interval
+                    busy, longest, iterations = 0, 0, 0
+            except socket.error as exc:
+                print("Socket error: " + str(exc))
+
+
+    def write_stats(self, now, elapsed, loop):
+        report = {
+            't': now,
+            'pid': os.getpid(),
+            'uptime': now - self.started,
+            'loop': loop,
+            'rooms': {name: room.report(now, elapsed) for name, room in self.rooms.items()},
+        }
+        tmp = self.stats_path + ".tmp"
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(report, f, indent=2)
+            os.replace(tmp, self.stats_path)
+        except OSError as exc:
+            print("Server: Could not write stats: " + str(exc))
+
+
+    def close(self):
+        for sock in self.socks:
+            sock.close()
+        for room in self.rooms.values():
+            room.close()
+
+
+def load_room(name, img_path, width, height, journal_dir=None, snapshot_every=500):
+    img = open_image(img_path)
+    room = Room(name, img, Puzzle(img, width, height), journal_dir, snapshot_every)
+    img.drop_tiles()
+    return room
+
+
+def run_worker(chan, specs, journal_dir, snapshot_every, stats_path=None, stats_interval=5):
+    rooms = {name: load_room(name, *spec, journal_dir, snapshot_every) for name, spec in specs.items()}
+    Worker(rooms, stats_path, stats_interval).run(chan)
+
+
+def serve_in_process(port, img, puzzle, name=DEFAULT_ROOM):
+    # host a single room on background threads, starting from an already built puzzle
+    room = Room(name, img, puzzle.copy())
     lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     lsock.bind(("0.0.0.0", port))
     lsock.listen(32)
-    clients = {}
-    indices = {}
-    cursors = {}
+    chan, worker_chan = socket.socketpair()
+    threading.Thread(target=Worker({name: room}).run, args=(worker_chan,), daemon=True).start()
+    threading.Thread(target=Lobby(lsock, {name: (chan, os.getpid())}).run, daemon=True).start()
+
 
-    to_read = [lsock]
-    while True:
+class Lobby():
+    def __init__(self, lsock, routes):
+        # routes maps each room name to the (channel, pid) of its worker
+        self.lsock = lsock
+        self.routes = routes
+        # clients mid-handshake, mapped to [bytes received so far, deadline]
+        self.pending = {}
+
+
+    def run(self):
+        while True:
+            try:
+                chans = {chan for chan, pid in self.routes.values()}
+                timeout = None
+                if self.pending:
+                    timeout = max(0, min(deadline for buf, deadline in self.pending.values()) - time.time())
+                ready_to_read, ready_to_write, in_error = \
+                    select.select([self.lsock] + list(chans) + list(self.pending), [], [], timeout)
+
+                for sock in ready_to_read:
+                    if sock == self.lsock:
+                        csock, addr = sock.accept()
+                        csock.setblocking(False)
+                        self.pending[csock] = [bytes(), time.time() + HANDSHAKE_TIMEOUT]
+                    elif sock in chans:
+                        # workers never write to their channel, so it only reads as ready once they've exited
+                        self.drop_worker(sock)
+                    else:
+                        self.receive(sock)
+
+                now = time.time()
+                for sock in [sock for sock, (buf, deadline) in self.pending.items() if deadline <= now]:
+                    self.drop(sock, "timed out")
+            except socket.error as exc:
+                print("Socket error: " + str(exc))
+
+
+    def drop(self, sock, reason):
+        print("Server: Dropped client during handshake: " + reason)
+        self.pending.pop(sock)
+        sock.close()
+
+
+    def drop_worker(self, chan):
+        names = [name for name, route in self.routes.items() if route[0] == chan]
+        print(f"Server: Worker {self.routes[names[0]][1]} exited, closing room(s) {', '.join(names)}")
+        for name in names:
+            self.routes.pop(name)
+        chan.close()
+        if not self.routes:
+            print("Error: All workers have exited")
+            sys.exit(1)
+
+
+    def receive(self, sock):
+        # read no further than the handshake, anything after it is for the worker
+        buf, deadline = self.pending[sock]
+        need = REQ_LEN + ROOM_LEN
+        if len(buf) >= need:
+            need += unpack_room_len(buf[REQ_LEN:need])[0]
         try:
-            ready_to_read, ready_to_write, in_error = \
-                select.select(to_read, [], [])
-
-            for sock in ready_to_read:
-                if sock == lsock:
-                    csock, addr = sock.accept()
-                    clients[csock] = 0
-                    idx = len(indices)
-                    indices[csock] = idx
-                    cursors[idx] = Cursor(idx).pack()
-                    to_read.append(csock)
-                    print("Server: Client connected")
-                    continue
-
-                req = sock.recv(REQ_LEN)
-                if req == IDX_REQ:
-                    sock.sendall(pack_idx(indices[sock]))
-                elif req == IMG_REQ:
-                    sock.sendall(img_res)
-                    sock.sendall(img_bytes)
-                elif req == INIT_REQ:
-                    sock.sendall(pack_init_res(len(initial_moves)))
-                    for m in initial_moves:
-                        sock.sendall(m)
-                elif req == UPDATE_REQ:
-                    idx = indices[sock]
-                    cursors[indices[sock]] = sock.recv(CURSOR_LEN)
-                    cpos = clients[sock]
-                    sock.sendall(pack_update_res(len(moves) - cpos, len(cursors) - 1))
-                    while cpos < len(moves):
-                        sock.sendall(moves[cpos])
-                        cpos += 1
-                    clients[sock] = cpos
-                    for i, c in cursors.items():
-                        if i != idx:
-                            sock.sendall(c)
-                elif req == MOVE_REQ:
-                    moves.append(sock.recv(MOVE_LEN))
-                elif req == bytes():
-                    print("Server: Client disconnected")
-                    cursors.pop(indices[sock])
-                    to_read.remove(sock)
-                else:
-                    print("Error: unknown request type " + str(req))
+            data = sock.recv(need - len(buf))
+        except BlockingIOError:
+            return
         except socket.error as exc:
-            print("Socket error: " + str(exc))
+            self.drop(sock, str(exc))
+            return
+        if data == bytes():
+            self.drop(sock, "connection closed")
+            return
+        buf += data
+        self.pending[sock][0] = buf
+
+        if buf[:REQ_LEN] != ROOM_REQ:
+            self.drop(sock, "expected a room request")
+        elif len(buf) >= REQ_LEN + ROOM_LEN:
+            name_len = unpack_room_len(buf[REQ_LEN:REQ_LEN + ROOM_LEN])[0]
+            if name_len > MAX_NAME_LEN:
+                self.drop(sock, "room name too long")
+            elif len(buf) == REQ_LEN + ROOM_LEN + name_len:
+                try:
+                    name = buf[REQ_LEN + ROOM_LEN:].decode()
+                except UnicodeDecodeError as exc:
+                    self.drop(sock, str(exc))
+                    return
+                self.pending.pop(sock)
+                self.route(sock, name)
+
+
+    def route(self, sock, name):
+        found = name in self.routes
+        try:
+            sock.setblocking(True)
+            sock.sendall(pack_room_res(found))
+        except socket.error as exc:
+            print("Server: Dropped client during handshake: " + str(exc))
+            sock.close()
+            return
+        if not found:
+            print(f"Server: Client asked for unknown room '{name}'")
+            sock.close()
+            return
+        chan, pid = self.routes[name]
+        try:
+            hand_off(chan, sock, name, pid)
+        except socket.error as exc:
+            # the worker died since the last select, its channel will report it next time around
+            print(f"Server: Could not hand client to the worker for room '{name}': " + str(exc))
+            sock.close()
+
+
+def parse_rooms(args):
+    rooms = {}
+    if args.puzzle:
+        if len(args.puzzle) != 3:
+            raise ValueError("Expected IMAGE WIDTH HEIGHT for the default room")
+        rooms[DEFAULT_ROOM] = args.puzzle
+    for room in args.room or []:
+        rooms[room[0]] = room[1:]
+    if args.rooms_file:
+        with open(args.rooms_file) as f:
+            for line in f:
+                line = line.split('#')[0].split()
+                if line:
+                    rooms[line[0]] = line[1:]
+    if not rooms:
+        raise ValueError("No rooms to host")
+    return {name: (img, int(w), int(h)) for name, (img, w, h) in rooms.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawTextHelpFormatter, description="""
+Host jigsaw puzzle rooms. Each room is served by one of a pool of worker processes.
+
+    Host a single 11x11 puzzle as the default room:
+
+        python3 server.py 7777 itachi.png 11 11
+
+    Host two rooms across two workers:
+
+        python3 server.py 7777 -r main itachi.png 11 11 -r kids rock.png 4 4 -w 2
+
+    Rooms can also be listed one per line ("NAME IMAGE WIDTH HEIGHT") in a file:
+
+        python3 server.py 7777 -f rooms.txt
+
+    Write each worker's metrics to stats/worker-N.json every 5 seconds:
+
+        python3 server.py 7777 itachi.png 11 11 --stats stats""")
+
+    parser.add_argument('port', help="Port to host from", type=int)
+    parser.add_argument('puzzle', help="Image and dimensions of the default room",
+                        nargs='*', metavar='IMAGE WIDTH HEIGHT')
+    parser.add_argument('-r', '--room', help="Host a named room",
+                        nargs=4, action='append', metavar=('NAME', 'IMAGE', 'WIDTH', 'HEIGHT'))
+    parser.add_argument('-f', '--rooms-file', help="Host the rooms listed in a file",
+                        metavar='FILE', default=None)
+    parser.add_argument('-j', '--journal', help="Journal moves to this directory and resume rooms from it",
+                        metavar='DIR', default=None)
+    parser.add_argument('--snapshot-every', help="Moves between journal snapshots (default=500)",
+                        metavar='MOVES', type=int, default=500)
+    parser.add_argument('-w', '--workers', help="Number of worker processes (default: one per CPU)",
+                        type=int, default=os.cpu_count() or 1)
+    parser.add_argument('--stats', help="Periodically write per-client and event loop metrics to this directory, as JSON",
+                        metavar='DIR', default=None)
+    parser.add_argument('--stats-interval', help="Seconds between metrics snapshots (default=5)",
+                        metavar='SECONDS', type=float, default=5)
+    args = parser.parse_args()
+
+    if args.snapshot_every < 1:
+        print("Error: Snapshot interval must be positive")
+        sys.exit(1)
+    if args.stats_interval <= 0:
+        print("Error: Stats interval must be positive")
+        sys.exit(1)
+    if args.stats != None:
+        os.makedirs(args.stats, exist_ok=True)
+
+    try:
+        rooms = parse_rooms(args)
+    except (ValueError, OSError) as exc:
+        print("Error: " + str(exc))
+        sys.exit(1)
+
+    # exit normally on SIGTERM so the daemon workers are taken down too
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    # take the port before loading rooms, so a busy one fails straight away
+    lsock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        lsock.bind(("0.0.0.0", args.port))
+        lsock.listen(32)
+    except OSError as exc:
+        print(f"Error: Could not listen on port {args.port}: {exc.strerror}")
+        sys.exit(1)
+
+    names = list(rooms.keys())
+    worker_count = max(1, min(args.workers, len(names)))
+    routes = {}
+    for i in range(worker_count):
+        chan, worker_chan = socket.socketpair()
+        specs = {name: rooms[name] for name in names[i::worker_count]}
+        stats_path = os.path.join(args.stats, f"worker-{i}.json") if args.stats != None else None
+        proc = mp.Process(target=run_worker, daemon=True,
+                          args=(worker_chan, specs, args.journal, args.snapshot_every, stats_path, args.stats_interval))
+        proc.start()
+        worker_chan.close()
+        for name in specs:
+            routes[name] = (chan, proc.pid)
+
+    print(f"Server: Hosting {len(names)} room(s) on {worker_count} worker(s)")
+    Lobby(lsock, routes).run()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
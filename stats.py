@@ -0,0 +1,114 @@
+import json
+import numpy as np
+import os
+os.environ['PYGAME_HIDE_SUPPORT_PROMPT'] = "hide"
+import pygame as pg
+import time
+
+from common import *
+
+
+class NullStats():
+    # stands in when instrumentation is off, so the main loop needn't check
+
+    overlay = False
+
+    def mark(self, phase):
+        pass
+
+
+    def end_frame(self, counters):
+        for name in counters:
+            counters[name] = 0
+
+
+    def draw(self, screen):
+        pass
+
+
+    def close(self):
+        pass
+
+
+class FrameStats():
+    # Times the phases of each frame and keeps the last `window` frames of
+    # them, along with the puzzle's rendering counters, for percentiles.
+
+    def __init__(self, window=300, overlay=True, log_path=None, log_interval=5):
+        self.window = window
+        self.overlay = overlay
+        self.times = {}
+        self.counts = {}
+        self.frames = 0
+        self.last = time.perf_counter()
+        self.frame_start = self.last
+        self.log = open(log_path, 'a') if log_path else None
+        self.log_interval = log_interval
+        self.log_time = time.time() + log_interval
+        self.font = None
+        self.lines = []
+        self.lines_time = 0
+
+
+    def record(self, series, name, value):
+        if name not in series:
+            series[name] = np.zeros(self.window)
+        series[name][self.frames % self.window] = value
+
+
+    def mark(self, phase):
+        # the time since the last mark is charged to this phase
+        now = time.perf_counter()
+        self.record(self.times, phase, now - self.last)
+        self.last = now
+
+
+    def end_frame(self, counters):
+        now = time.perf_counter()
+        self.record(self.times, 'frame', now - self.frame_start)
+        self.frame_start = self.last = now
+        for name, value in counters.items():
+            self.record(self.counts, name, value)
+            counters[name] = 0
+        self.frames += 1
+
+        if self.log != None and time.time() >= self.log_time:
+            self.log_time = time.time() + self.log_interval
+            self.log.write(json.dumps(self.summary()) + "\n")
+            self.log.flush()
+
+
+    def summary(self):
+        n = min(self.frames, self.window)
+        return {
+            't': time.time(),
+            'frames': self.frames,
+            'seconds': {phase: summarize(times[:n]) for phase, times in self.times.items()},
+            'per_frame': {name: {'mean': float(counts[:n].mean()), 'max': float(counts[:n].max())}
+                          for name, counts in self.counts.items()},
+        }
+
+
+    def draw(self, screen):
+        if not self.overlay or self.frames == 0:
+            return
+        # percentiles only change noticeably over many frames, so the text is rebuilt twice a second
+        if time.time() - self.lines_time > 0.5:
+            self.lines_time = time.time()
+            if self.font == None:
+                self.font = pg.font.Font(None, 20)
+            summary = self.summary()
+            text = [f"{phase:8} p50 {s['p50'] * 1000:6.2f}ms  p99 {s['p99'] * 1000:6.2f}ms"
+                    for phase, s in summary['seconds'].items()]
+            text.append("  ".join(f"{name} {c['mean']:.0f}" for name, c in summary['per_frame'].items()))
+            self.lines = [self.font.render(line, True, WHITE, BLACK) for line in text]
+        y = 4
+        for line in self.lines:
+            screen.blit(line, (4, y))
+            y += line.get_height()
+
+
+    def close(self):
+        if self.log != None:
+            self.log.write(json.dumps(self.summary()) + "\n")
+            self.log.close()
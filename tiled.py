@@ -0,0 +1,305 @@
+from collections import OrderedDict
+import hashlib
+from math import ceil, floor
+import numpy as np
+import os
+from PIL import Image
+import struct
+import uuid
+import zlib
+
+
+TILE_SIZE = 512
+TILE_CACHE_BYTES = 64 * 2**20
+
+# sources bigger than this many pixels are decoded a band at a time, or at reduced scale for JPEGs
+DECODE_BUDGET = 2**26
+# pixels decoded at a time when a source is decoded in bands
+BAND_PIXELS = 2**22
+# bits per pixel of the raw layouts that don't state their row stride
+RAW_BITS = {'1': 1, 'L': 8, 'P': 8, 'RGB': 24, 'RGBA': 32, 'RGBX': 32, 'CMYK': 32,
+            'I;16': 16, 'I;16B': 16, 'I': 32, 'F': 32}
+# PIL's bomb check is raised to this for sources that are decoded in bands or drafted down,
+# as their memory is bounded by the above; sources decoded whole keep PIL's own limit
+MAX_SOURCE_PIXELS = 2**34
+
+TILE_MAGIC = "JUFT".encode()
+TILE_HEADER_FMT = ">4sIII"
+TILE_HEADER_LEN = len(struct.pack(TILE_HEADER_FMT, TILE_MAGIC, 1, 2, 3))
+TILE_LEN_FMT = ">I"
+TILE_LEN_LEN = len(struct.pack(TILE_LEN_FMT, 1))
+
+
+def tile_boxes(size, tile_size):
+    w, h = size
+    for y in range(0, h, tile_size):
+        for x in range(0, w, tile_size):
+            yield (x, y, min(x + tile_size, w), min(y + tile_size, h))
+
+
+def fit_size(size, max_dim):
+    w, h = size
+    if max(w, h) <= max_dim:
+        return size
+    if w > h:
+        return max_dim, max(1, int(h * max_dim / w))
+    else:
+        return max(1, int(w * max_dim / h)), max_dim
+
+
+def write_tiles(path, size, tile_size, tiles):
+    # tiles are written row-major, each as a length-prefixed zlib stream of RGB
+    # unique, since a viewer export may be resampling the same image alongside
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp, 'wb') as f:
+        f.write(struct.pack(TILE_HEADER_FMT, TILE_MAGIC, size[0], size[1], tile_size))
+        for tile in tiles:
+            data = zlib.compress(tile.tobytes("raw", 'RGB'), 1)
+            f.write(struct.pack(TILE_LEN_FMT, len(data)))
+            f.write(data)
+    os.replace(tmp, path)
+
+
+def open_image(path, cache_dir="image_cache", tile_size=TILE_SIZE):
+    with open(path, 'rb') as f:
+        if f.read(len(TILE_MAGIC)) == TILE_MAGIC:
+            return TiledImage(path)
+
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}:{st.st_mtime_ns}:{st.st_size}:{tile_size}"
+    tiled_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".tiles")
+    if not os.path.exists(tiled_path):
+        os.makedirs(cache_dir, exist_ok=True)
+        # opening only reads the header, the limit that applies depends on how the source will be decoded
+        limit, Image.MAX_IMAGE_PIXELS = Image.MAX_IMAGE_PIXELS, MAX_SOURCE_PIXELS
+        try:
+            # the only decode of the source, reused until the file changes
+            with open_source(path) as src:
+                w, h = src.size
+                if band_spans(src) == None and limit != None and w * h > limit:
+                    raise Image.DecompressionBombError(
+                        f"{src.format} image of {w}x{h} pixels would be decoded whole, which is over "
+                        f"the limit of {limit} pixels; save it as a JPEG, BMP or uncompressed TIFF to use it")
+                write_tiles(tiled_path, src.size, tile_size, source_tiles(path, src, tile_size))
+        finally:
+            Image.MAX_IMAGE_PIXELS = limit
+    return TiledImage(tiled_path)
+
+
+def open_source(path, budget=DECODE_BUDGET):
+    src = Image.open(path)
+    w, h = src.size
+    if src.format == 'JPEG' and w * h > budget:
+        # JPEGs decode in one pass, but can be decoded at 1/2, 1/4 or 1/8 scale
+        scale = next((s for s in (2, 4, 8) if ceil(w / s) * ceil(h / s) <= budget), 8)
+        src.draft('RGB', (ceil(w / scale), ceil(h / scale)))
+        print(f"Warning: {path} is {w}x{h}, so it is decoded and cached at 1/{scale} scale, "
+              f"as {src.size[0]}x{src.size[1]}")
+    return src
+
+
+def raw_layout(entry):
+    # (rawmode, row stride, ystep) of an uncompressed tile, or None if it isn't one we can cut
+    name, (x0, y0, x1, y1), offset, args = entry
+    if name != 'raw':
+        return None
+    rawmode, stride, ystep = (tuple(args) + (0, 1))[:3] if isinstance(args, tuple) else (args, 0, 1)
+    if stride == 0:
+        if rawmode not in RAW_BITS:
+            return None
+        stride = ceil((x1 - x0) * RAW_BITS[rawmode] / 8)
+    return rawmode, stride, ystep
+
+
+def raw_strips(entry, rows):
+    # an uncompressed tile is laid out row by row, so it can be cut into strips of its own
+    name, (x0, y0, x1, y1), offset, args = entry
+    rawmode, stride, ystep = raw_layout(entry)
+    h = y1 - y0
+    for top in range(0, h, rows):
+        bottom = min(top + rows, h)
+        # bottom-up streams, like BMP's, store the last rows first
+        skip = top if ystep > 0 else h - bottom
+        yield (x0, y0 + top, x1, y0 + bottom), offset + skip * stride, (rawmode, stride, ystep)
+
+
+def band_spans(src, budget=DECODE_BUDGET):
+    # the strips of an uncompressed source, by the rows they cover, or None if it is decoded whole
+    w, h = src.size
+    band_rows = max(1, BAND_PIXELS // w)
+    rows = {}
+    if w * h > budget and src.tile and src.mode not in ('P', 'PA') and \
+            all(raw_layout(entry) != None for entry in src.tile):
+        for entry in src.tile:
+            for strip in raw_strips(entry, band_rows):
+                x0, y0, x1, y1 = strip[0]
+                rows.setdefault((y0, y1), []).append(strip)
+    spans = sorted(rows)
+    if not spans or spans[0][0] != 0 or spans[-1][1] != h or \
+            any(a[1] != b[0] for a, b in zip(spans, spans[1:])):
+        return None
+    return rows
+
+
+def decode_bands(path, src, budget=DECODE_BUDGET):
+    # yields (top row, image) for consecutive bands of rows covering the source
+    w, h = src.size
+    band_rows = max(1, BAND_PIXELS // w)
+    rows = band_spans(src, budget)
+    if rows == None:
+        # small enough, or compressed as a single stream, so decoded whole
+        src.load()
+        yield 0, src
+        return
+
+    spans = sorted(rows)
+    with open(path, 'rb') as f:
+        while spans:
+            top = spans[0][0]
+            group = []
+            while spans and (not group or spans[0][1] - top <= band_rows):
+                group.append(spans.pop(0))
+            band = Image.new(src.mode, (w, group[-1][1] - top))
+            for span in group:
+                for (x0, y0, x1, y1), offset, (rawmode, stride, ystep) in rows[span]:
+                    f.seek(offset)
+                    data = f.read(stride * (y1 - y0))
+                    strip = Image.frombytes(src.mode, (x1 - x0, y1 - y0), data, 'raw', rawmode, stride, ystep)
+                    band.paste(strip, (x0, y0 - top))
+            yield top, band if band.mode == 'RGB' else band.convert('RGB')
+
+
+def source_tiles(path, src, tile_size, budget=DECODE_BUDGET):
+    w, h = src.size
+    bands = decode_bands(path, src, budget)
+    top, band = next(bands)
+    if band.size == (w, h):
+        for box in tile_boxes(src.size, tile_size):
+            yield band.crop(box).convert('RGB')
+        return
+
+    for ty0 in range(0, h, tile_size):
+        ty1 = min(ty0 + tile_size, h)
+        # gather this row of tiles from however many bands it spans
+        strip = Image.new('RGB', (w, ty1 - ty0))
+        while top + band.size[1] <= ty0:
+            top, band = next(bands)
+        while True:
+            y0, y1 = max(ty0, top), min(ty1, top + band.size[1])
+            strip.paste(band.crop((0, y0 - top, w, y1 - top)), (0, y0 - ty0))
+            if top + band.size[1] >= ty1:
+                break
+            top, band = next(bands)
+        for x0, y0, x1, y1 in tile_boxes((w, ty1 - ty0), tile_size):
+            yield strip.crop((x0, y0, x1, y1))
+
+
+class TiledImage():
+    def __init__(self, path, max_bytes=TILE_CACHE_BYTES):
+        self.path = path
+        self.file = open(path, 'rb')
+        magic, w, h, self.tile_size = struct.unpack(TILE_HEADER_FMT, self.file.read(TILE_HEADER_LEN))
+        if magic != TILE_MAGIC:
+            raise ValueError("Not a tiled image: " + path)
+        self.size = (w, h)
+        self.cols, self.rows = ceil(w / self.tile_size), ceil(h / self.tile_size)
+        self.boxes = list(tile_boxes(self.size, self.tile_size))
+        self.index = []
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.tiles = OrderedDict()
+        self.scan()
+
+
+    def scan(self):
+        # index whatever tiles have been fully written so far
+        offset = self.index[-1][0] + self.index[-1][1] if self.index else TILE_HEADER_LEN
+        end = os.path.getsize(self.path)
+        while len(self.index) < len(self.boxes) and offset + TILE_LEN_LEN <= end:
+            self.file.seek(offset)
+            length = struct.unpack(TILE_LEN_FMT, self.file.read(TILE_LEN_LEN))[0]
+            if offset + TILE_LEN_LEN + length > end:
+                break
+            self.index.append((offset + TILE_LEN_LEN, length))
+            offset += TILE_LEN_LEN + length
+
+
+    def complete(self):
+        return len(self.index) == len(self.boxes)
+
+
+    def available(self):
+        return len(self.index)
+
+
+    def last_tiles(self, boxes):
+        # tiles arrive row-major, so a box is ready once its bottom right tile is
+        boxes = np.round(boxes).astype(int)
+        tx = np.clip((boxes[:, 2] - 1) // self.tile_size, 0, self.cols - 1)
+        ty = np.clip((boxes[:, 3] - 1) // self.tile_size, 0, self.rows - 1)
+        return ty * self.cols + tx
+
+
+    def tile(self, t):
+        img = self.tiles.get(t)
+        if img != None:
+            self.tiles.move_to_end(t)
+            return img
+
+        offset, length = self.index[t]
+        self.file.seek(offset)
+        x0, y0, x1, y1 = self.boxes[t]
+        img = Image.frombytes('RGB', (x1 - x0, y1 - y0), zlib.decompress(self.file.read(length)))
+        self.tiles[t] = img
+        self.bytes += img.size[0] * img.size[1] * 3
+        while self.bytes > self.max_bytes and len(self.tiles) > 1:
+            old = self.tiles.popitem(last=False)[1]
+            self.bytes -= old.size[0] * old.size[1] * 3
+        return img
+
+
+    def crop(self, box):
+        # same rounding and zero padding as PIL's Image.crop
+        x0, y0, x1, y1 = map(int, map(round, box))
+        out = Image.new('RGB', (x1 - x0, y1 - y0))
+        ts = self.tile_size
+        for ty in range(max(0, y0 // ts), min(self.rows, ceil(y1 / ts))):
+            for tx in range(max(0, x0 // ts), min(self.cols, ceil(x1 / ts))):
+                out.paste(self.tile(ty * self.cols + tx), (tx * ts - x0, ty * ts - y0))
+        return out
+
+
+    def resize(self, size):
+        # halve repeatedly so no step reads more than a couple of tiles per output tile
+        img = self
+        while img.size[0] // 2 >= size[0] and img.size[1] // 2 >= size[1]:
+            img = img.resample((img.size[0] // 2, img.size[1] // 2))
+        if img.size == tuple(size):
+            return img
+        return img.resample(size)
+
+
+    def resample(self, size):
+        path = os.path.splitext(self.path)[0] + f"_{size[0]}x{size[1]}.tiles"
+        if not os.path.exists(path):
+            fx, fy = self.size[0] / size[0], self.size[1] / size[1]
+            def tiles():
+                for x0, y0, x1, y1 in tile_boxes(size, self.tile_size):
+                    sx0, sy0, sx1, sy1 = x0 * fx, y0 * fy, x1 * fx, y1 * fy
+                    ix, iy = floor(sx0), floor(sy0)
+                    region = self.crop((ix, iy, min(ceil(sx1), self.size[0]), min(ceil(sy1), self.size[1])))
+                    yield region.resize((x1 - x0, y1 - y0), Image.BICUBIC,
+                                        box=(sx0 - ix, sy0 - iy,
+                                             min(sx1 - ix, region.size[0]), min(sy1 - iy, region.size[1])))
+            write_tiles(path, size, self.tile_size, tiles())
+        return TiledImage(path, self.max_bytes)
+
+
+    def drop_tiles(self):
+        # for images that are only served from their file from here on
+        self.tiles.clear()
+        self.bytes = 0
+
+
+    def close(self):
+        self.file.close()